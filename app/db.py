@@ -0,0 +1,16 @@
+import os
+from typing import Optional
+
+
+def prepare_threshold_from_env(name: str = "PG_PREPARE_THRESHOLD", default: str = "0") -> Optional[int]:
+    # 0 — prepared statement с первого выполнения; "none" — для pgbouncer в transaction mode
+    raw = (os.getenv(name) or default).strip()
+    if raw.lower() == "none":
+        return None
+    try:
+        value = int(raw)
+    except ValueError:
+        value = -1
+    if value < 0:
+        raise SystemExit(f"⛔ {name}={raw!r}: нужно целое число ≥ 0 или none")
+    return value
@@ -1,10 +1,16 @@
 import os, sys, re, json, hashlib
 from datetime import datetime, timezone
-from typing import Optional, Tuple, Dict, Any, List
+from typing import Optional, Tuple, Dict, Any, List, Iterator
 
 import psycopg
 from psycopg.rows import dict_row
 
+# быстрый сканер ключевых слов (опционально; без него — одна общая регулярка)
+try:
+    import ahocorasick  # type: ignore
+except Exception:  # pragma: no cover
+    ahocorasick = None  # type: ignore
+
 # ---------- utils ----------
 def log(msg: str):
     now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
@@ -17,6 +23,9 @@ def env(name: str) -> str:
     return v
 
 DB_URL = env("DATABASE_URL")
+# md5 — как в уже записанных jobs.dedup_hash; blake2b (16 байт, та же длина hex) быстрее,
+# но включать DEDUP_HASH=blake2b только вместе с пересчётом старых хешей
+DEDUP_HASH = os.getenv("DEDUP_HASH", "md5")
 
 CURRENCY_MAP = {
     "₽": "RUB", "руб": "RUB", "р.": "RUB", "р ": "RUB", "т.р": "RUB", "тр": "RUB", "тыс": "RUB",
@@ -40,205 +49,305 @@ SEEKER_MARKERS = [
 ]
 EMPLOYER_MARKERS = ["вакансия", "требуется", "нужен", "открыта позиция", "примем", "ищем"]
 
-RE_PHONE = re.compile(r"(?:\+?\d[\s\-()]?){10,13}")
-RE_EMAIL = re.compile(r"[A-Za-z0-9._%+\-]+@[A-Za-z0-9.\-]+\.[A-Za-z]{2,}")
-RE_TG    = re.compile(r"(?:@|t\.me/)([A-Za-z0-9_]{3,})")
-
-def _find_currency(text: str) -> str:
-    t = text.lower()
-    for k, v in CURRENCY_MAP.items():
-        if k in t:
-            return v
-    return "UNKNOWN"
-
-def _find_period(text: str) -> str:
-    t = text.lower()
-    for p, keys in PERIOD_WORDS.items():
-        if any(k in t for k in keys):
-            return p
-    return "unknown"
-
-def _parse_salary(text: str) -> Tuple[Optional[float], Optional[float], str, str, str]:
-    t = text.lower().replace(" ", " ").replace("\u00A0", " ")
-    # числа вида 200 000–250 000 / 200-250 / 200–250 т.р / 200к
-    rng = re.search(r"(\d[\d\s]{1,9})\s*[–\-]\s*(\d[\d\s]{1,9})\s*(к|k|тыс|т\.р|тр)?", t)
-    single = re.search(r"(?:от|≈|~)?\s*(\d[\d\s]{2,9})\s*(к|k|тыс|т\.р|тр)?", t)
-
-    mul = 1.0
-    def to_num(s: str, suf: Optional[str]) -> float:
-        x = float(re.sub(r"\s+", "", s))
-        if suf and suf in ("к","k","тыс","т.р","тр"):
-            return x * 1000.0
-        return x
-
-    currency = _find_currency(t)
-    period = _find_period(t)
-    raw = ""
-
-    if rng:
-        raw = rng.group(0)
-        mn = to_num(rng.group(1), rng.group(3))
-        mx = to_num(rng.group(2), rng.group(3))
-        if mn > mx: mn, mx = mx, mn
-        return mn, mx, currency, period, raw
+SCHEDULE_WORDS = {
+    "вахта": ["вахт"],
+    "командировка": ["командиров"],
+    "remote": ["удален", "remote", "дистанц"],
+    "офис": ["офис"],
+    "hybrid": ["гибрид", "hybrid"],
+}
+EMPLOYMENT_WORDS = {
+    "full": ["полная", "full"],
+    "part": ["частич", "part"],
+    "contract": ["подряд", "контракт", "contract"],
+    "intern": ["стаж", "intern"],
+}
 
-    if single:
-        raw = single.group(0)
-        val = to_num(single.group(1), single.group(2))
-        return val, val, currency, period, raw
+# телефон / email / telegram одним проходом; email первым, чтобы его цифры и "@..."
+# не уходили в телефон и telegram. Телефон — один символьный класс без повторяемой
+# группы (линейно, без бэктрекинга); цифры считаем уже в _contacts, а кандидата режем
+# по " - ", чтобы вилка зарплаты "120 000 - 150 000" не сошла за номер
+RE_CONTACT = re.compile(
+    r"(?P<email>[A-Za-z0-9._%+\-]+@[A-Za-z0-9.\-]+\.[A-Za-z]{2,})"
+    r"|(?P<phone>\+?\d[\d\s\-()]{9,24})"
+    r"|(?:@|t\.me/)(?P<tg>[A-Za-z0-9_]{3,})"
+)
+RE_RANGE_DASH = re.compile(r"\s+-\s*|\s*-\s+")
+PHONE_MIN_DIGITS = 10
 
-    return None, None, currency, period, raw
+# числа вида 200 000–250 000 / 200-250 / 200–250 т.р / 200к — вилка или одно число
+# в одной регулярке; префикс "от" есть и у вилки, чтобы одиночное число не съело её начало
+RE_SAL = re.compile(
+    r"(?:от|≈|~)?\s*(?P<rmin>\d[\d\s]{1,9})\s*[–\-]\s*(?P<rmax>\d[\d\s]{1,9})\s*(?P<rsuf>к|k|тыс|т\.р|тр)?"
+    r"|(?:от|≈|~)?\s*(?P<sval>\d[\d\s]{2,9})\s*(?P<ssuf>к|k|тыс|т\.р|тр)?"
+)
+RE_ROLE = re.compile(r"(инженер[\-\s]?геодезист|геодезист|геодез\.|инженер[\-\s]?геодезии)")
+RE_CITY = re.compile(r"(?:г\.|город|в\s+городе)\s*([A-ЯЁA-Za-z\-\s]+)")
+RE_WS   = re.compile(r"\s+")
+
+# ---------- keyword scan ----------
+# все словари в одном сканере — один проход по тексту;
+# rank — порядок в словаре: при нескольких совпадениях побеждает более ранний ключ
+def _keyword_tags() -> Dict[str, Tuple[Tuple[str, int, str], ...]]:
+    tags: Dict[str, List[Tuple[str, int, str]]] = {}
+
+    def add(word: str, kind: str, rank: int, value: str):
+        tags.setdefault(word, []).append((kind, rank, value))
+
+    for rank, (k, v) in enumerate(CURRENCY_MAP.items()):
+        add(k, "currency", rank, v)
+    for kind, groups in (("period", PERIOD_WORDS), ("schedule", SCHEDULE_WORDS), ("employment", EMPLOYMENT_WORDS)):
+        for rank, (value, keys) in enumerate(groups.items()):
+            for k in keys:
+                add(k, kind, rank, value)
+    for kind, words in (("equipment", EQUIP_WORDS), ("software", SOFT_WORDS)):
+        for w in words:
+            add(w, kind, 0, w.upper() if w.isalpha() else w)
+    for kind, words in (("seeker", SEEKER_MARKERS), ("employer", EMPLOYER_MARKERS)):
+        for w in words:
+            add(w, kind, 0, kind)
+    return {w: tuple(t) for w, t in tags.items()}
+
+KEYWORD_TAGS = _keyword_tags()
+
+if ahocorasick is not None:
+    KEYWORDS = ahocorasick.Automaton()
+    for _w, _tags in KEYWORD_TAGS.items():
+        KEYWORDS.add_word(_w, _tags)
+    KEYWORDS.make_automaton()
+
+    def _keyword_hits(t: str):
+        return (tags for _, tags in KEYWORDS.iter(t))
+else:
+    # альтернатива «длинные ключи первыми» внутри lookahead находит совпадение в каждой
+    # позиции; более короткие ключи, начинающиеся там же, — это префиксы найденного
+    RE_KEYWORDS = re.compile(
+        "(?=(" + "|".join(re.escape(k) for k in sorted(KEYWORD_TAGS, key=len, reverse=True)) + "))"
+    )
+    _PREFIX_TAGS = {
+        k: tuple(tag for p, tags in KEYWORD_TAGS.items() if k.startswith(p) for tag in tags)
+        for k in KEYWORD_TAGS
+    }
+
+    def _keyword_hits(t: str):
+        return (_PREFIX_TAGS[m.group(1)] for m in RE_KEYWORDS.finditer(t))
+
+def _scan_keywords(t: str) -> Dict[str, Any]:
+    # t — уже в lower()
+    best: Dict[str, Tuple[int, str]] = {}
+    eq, sw, marks = set(), set(), set()
+    for tags in _keyword_hits(t):
+        for kind, rank, value in tags:
+            if kind == "equipment":
+                eq.add(value)
+            elif kind == "software":
+                sw.add(value)
+            elif kind in ("seeker", "employer"):
+                marks.add(kind)
+            elif kind not in best or rank < best[kind][0]:
+                best[kind] = (rank, value)
+
+    def first(kind: str, default: str) -> str:
+        hit = best.get(kind)
+        return hit[1] if hit else default
 
-def _contacts(text: str) -> Dict[str, Optional[str]]:
-    phones = RE_PHONE.findall(text)
-    emails = RE_EMAIL.findall(text)
-    tg = RE_TG.findall(text)
     return {
-        "phone": phones[0] if phones else None,
-        "email": emails[0] if emails else None,
-        "telegram": ("@" + tg[0]) if tg else None,
+        "currency": first("currency", "UNKNOWN"),
+        "period": first("period", "unknown"),
+        "schedule": first("schedule", "unknown"),
+        "employment": first("employment", "unknown"),
+        "equipment": sorted(eq),
+        "software": sorted(sw),
+        "is_employer": _is_employer(marks),
     }
 
-def _schedule(text: str) -> str:
-    t = text.lower()
-    if "вахт" in t: return "вахта"
-    if "командиров" in t: return "командировка"
-    if "удален" in t or "remote" in t or "дистанц" in t: return "remote"
-    if "офис" in t: return "офис"
-    if "гибрид" in t or "hybrid" in t: return "hybrid"
-    return "unknown"
-
-def _employment(text: str) -> str:
-    t = text.lower()
-    if "полная" in t or "full" in t: return "full"
-    if "частич" in t or "part" in t: return "part"
-    if "подряд" in t or "контракт" in t or "contract" in t: return "contract"
-    if "стаж" in t or "intern" in t: return "intern"
-    return "unknown"
-
-def _equip_soft(text: str) -> Tuple[List[str], List[str]]:
-    t = text.lower()
-    eq = sorted({w.upper() if w.isalpha() else w for w in EQUIP_WORDS if w in t})
-    sw = sorted({w.upper() if w.isalpha() else w for w in SOFT_WORDS if w in t})
-    return eq, sw
-
-def _role(text: str) -> str:
-    # простая эвристика
-    m = re.search(r"(инженер[\-\s]?геодезист|геодезист|геодез\.|инженер[\-\s]?геодезии)", text.lower())
+THOUSAND_SUFFIXES = frozenset(("к", "k", "тыс", "т.р", "тр"))
+
+def _to_num(s: str, suf: Optional[str]) -> float:
+    x = float(RE_WS.sub("", s))
+    if suf in THOUSAND_SUFFIXES:
+        return x * 1000.0
+    return x
+
+def _parse_salary(t: str) -> Tuple[Optional[float], Optional[float], str]:
+    # t — уже в lower() и без неразрывных пробелов; вилка приоритетнее одиночного числа,
+    # даже если одиночное встретилось раньше
+    single = None
+    for m in RE_SAL.finditer(t):
+        if m.group("rmin") is not None:
+            mn = _to_num(m.group("rmin"), m.group("rsuf"))
+            mx = _to_num(m.group("rmax"), m.group("rsuf"))
+            if mn > mx: mn, mx = mx, mn
+            return mn, mx, m.group(0)
+        if single is None:
+            single = m
+
+    if single:
+        val = _to_num(single.group("sval"), single.group("ssuf"))
+        return val, val, single.group(0)
+
+    return None, None, ""
+
+def _contacts(text: str) -> Dict[str, Optional[str]]:
+    found: Dict[str, Optional[str]] = {"phone": None, "email": None, "telegram": None}
+    for m in RE_CONTACT.finditer(text):
+        kind = m.lastgroup
+        key = "telegram" if kind == "tg" else kind
+        if found[key] is not None:
+            continue
+        if kind == "phone":
+            phone = next(
+                (p for p in RE_RANGE_DASH.split(m.group(0)) if sum(c.isdigit() for c in p) >= PHONE_MIN_DIGITS),
+                None,
+            )
+            if phone is None:
+                continue
+            found[key] = phone.strip().rstrip("-(")
+        else:
+            found[key] = ("@" + m.group("tg")) if kind == "tg" else m.group(0)
+        if all(found.values()):
+            break
+    return found
+
+def _role(t: str) -> str:
+    # простая эвристика; все варианты RE_ROLE содержат "геодез" — без него regex не нужен
+    m = RE_ROLE.search(t) if "геодез" in t else None
     return (m.group(1) if m else "Геодезист").capitalize()
 
-def _is_employer(text: str) -> bool:
-    tl = text.lower()
-    if any(x in tl for x in SEEKER_MARKERS): return False
-    if any(x in tl for x in EMPLOYER_MARKERS): return True
+def _is_employer(marks: set) -> bool:
+    # marks — виды маркеров, найденных общим сканером ключевых слов
+    if "seeker" in marks: return False
+    if "employer" in marks: return True
     # по умолчанию считаем, что это вакансия
     return True
 
 def _city_country(text: str) -> Tuple[Optional[str], Optional[str], Optional[str]]:
     # лёгкая эвристика; детальную геокодировку добавим позже
-    m = re.search(r"(?:г\.|город|в\s+городе)\s*([A-ЯЁA-Za-z\-\s]+)", text)
+    # "в городе" тоже содержит "город", так что подстрок хватает для раннего выхода
+    if "г." not in text and "город" not in text:
+        return None, None, None
+    m = RE_CITY.search(text)
     city = m.group(1).strip() if m else None
     return city, None, None
 
-def _dedup_hash(text: str) -> str:
-    clean = re.sub(r"\s+", " ", text).strip().lower()
-    return hashlib.md5(clean.encode("utf-8")).hexdigest()
+def _dedup_hash(clean: str) -> str:
+    data = clean.encode("utf-8")
+    if DEDUP_HASH == "blake2b":
+        return hashlib.blake2b(data, digest_size=16).hexdigest()
+    return hashlib.md5(data).hexdigest()
+
+# порядок колонок jobs, которые заполняет parse_job; совпадает с INSERT_JOB_SQL
+JOB_COLS = (
+    "role", "employer_name", "is_employer", "description",
+    "contact_telegram", "contact_phone", "contact_email",
+    "salary_min", "salary_max", "salary_currency", "salary_period",
+    "employment_type", "schedule_type",
+    "city", "region", "country",
+    "equipment", "software",
+    "experience", "language",
+    "dedup_hash", "confidence",
+)
 
-def parse_job(text: str) -> Dict[str, Any]:
-    salary_min, salary_max, currency, period, salary_raw = _parse_salary(text)
+def parse_job(text: str) -> tuple:
+    # кортеж в порядке JOB_COLS — сразу годится для executemany, без промежуточного dict
+    # lower() и нормализация пробелов — один раз на сообщение
+    t = text.lower().replace("\u00A0", " ")
+    clean = RE_WS.sub(" ", t).strip()
+    salary_min, salary_max, _ = _parse_salary(t)
+    kw = _scan_keywords(t)
     contacts = _contacts(text)
-    schedule = _schedule(text)
-    employment = _employment(text)
-    eq, sw = _equip_soft(text)
-    role = _role(text)
-    is_emp = _is_employer(text)
     city, region, country = _city_country(text)
-    return {
-        "role": role,
-        "is_employer": is_emp,
-        "description": text,
-        "salary_min": salary_min, "salary_max": salary_max,
-        "salary_currency": currency, "salary_period": period,
-        "contact_phone": contacts["phone"],
-        "contact_email": contacts["email"],
-        "contact_telegram": contacts["telegram"],
-        "schedule_type": schedule,
-        "employment_type": employment,
-        "equipment": eq, "software": sw,
-        "city": city, "region": region, "country": country,
-        "dedup_hash": _dedup_hash(text),
-        "confidence": 0.5,  # заглушка, позже дадим нормальную оценку
-    }
+    return (
+        _role(t), None, kw["is_employer"], text,
+        contacts["telegram"], contacts["phone"], contacts["email"],
+        salary_min, salary_max, kw["currency"], kw["period"],
+        kw["employment"], kw["schedule"],
+        city, region, country,
+        kw["equipment"], kw["software"],
+        None, None,
+        _dedup_hash(clean),
+        0.5,  # confidence: заглушка, позже дадим нормальную оценку
+    )
 
 # ---------- DB pipeline ----------
 def get_conn():
     return psycopg.connect(DB_URL, row_factory=dict_row)
 
-def fetch_unprocessed(cur, limit=200) -> List[Dict[str, Any]]:
-    cur.execute("""
-        select ri.id as raw_id, ri.text_raw, ri.published_at, ri.source_id
-        from public.raw_items ri
-        left join public.jobs j on j.raw_item_id = ri.id
-        where j.id is null
-          and coalesce(ri.text_raw, '') <> ''
-        order by ri.id asc
-        limit %s
-    """, (limit,))
-    return cur.fetchall()
-
-def insert_job(cur, row: Dict[str, Any]):
-    data = parse_job(row["text_raw"])
-    cur.execute("""
-        insert into public.jobs
-            (source_id, raw_item_id, role, employer_name, is_employer, description,
-             contact_telegram, contact_phone, contact_email,
-             salary_min, salary_max, salary_currency, salary_period,
-             employment_type, schedule_type,
-             city, region, country,
-             equipment, software,
-             experience, language,
-             dedup_hash, confidence, posted_at)
-        values
-            (%s,%s,%s,%s,%s,%s,
-             %s,%s,%s,
-             %s,%s,%s,%s,
-             %s,%s,
-             %s,%s,%s,
-             %s,%s,
-             %s,%s,
-             %s,%s,%s)
-        on conflict do nothing
-        returning id
-    """, (
-        row["source_id"], row["raw_id"],
-        data["role"], None, data["is_employer"], data["description"],
-        data["contact_telegram"], data["contact_phone"], data["contact_email"],
-        data["salary_min"], data["salary_max"], data["salary_currency"], data["salary_period"],
-        data["employment_type"], data["schedule_type"],
-        data["city"], data["region"], data["country"],
-        data["equipment"], data["software"],
-        None, None,
-        data["dedup_hash"], data["confidence"], row["published_at"]
-    ))
-    r = cur.fetchone()
-    return r["id"] if r else None
+FETCH_ITERSIZE = 100   # строк за один round trip серверного курсора
+FLUSH_EVERY = 500      # строк jobs на один executemany
+
+def fetch_unprocessed(conn) -> Iterator[Dict[str, Any]]:
+    # серверный (именованный) курсор: строки приходят пачками по itersize,
+    # разбор идёт параллельно с сетью, память — O(пачки), а не O(бэклога).
+    # withhold — курсор переживает commit после каждой пачки вставок
+    with conn.cursor(name="extract_cur", withhold=True) as cur:
+        cur.itersize = FETCH_ITERSIZE
+        cur.execute("""
+            select ri.id as raw_id, ri.text_raw, ri.published_at, ri.source_id
+            from public.raw_items ri
+            left join public.jobs j on j.raw_item_id = ri.id
+            where j.id is null
+              and coalesce(ri.text_raw, '') <> ''
+            order by ri.id asc
+        """)
+        yield from cur
+
+INSERT_COLS = ("source_id", "raw_item_id", *JOB_COLS, "posted_at")
+INSERT_JOB_SQL = (
+    f"insert into public.jobs ({', '.join(INSERT_COLS)}) "
+    f"values ({', '.join(['%s'] * len(INSERT_COLS))}) "
+    "on conflict do nothing"
+)
+
+def job_params(row: Dict[str, Any]) -> tuple:
+    return (row["source_id"], row["raw_id"], *parse_job(row["text_raw"]), row["published_at"])
+
+def insert_jobs(cur, params: List[tuple]) -> int:
+    # один executemany на пачку вместо round trip на каждую строку
+    if not params:
+        return 0
+    cur.executemany(INSERT_JOB_SQL, params)
+    return cur.rowcount
+
+def flush_jobs(conn, cur, params: List[tuple]) -> int:
+    # пачка — под savepoint и сразу commit: сбой не откатывает уже записанное и не держит
+    # транзакцию на весь бэклог; упавшую пачку дописываем по одной, пропуская «плохие» строки
+    if not params:
+        return 0
+    try:
+        with conn.transaction():
+            n = insert_jobs(cur, params)
+    except psycopg.Error as e:
+        log(f"⚠️ batch insert failed ({e}) — inserting one by one")
+        n = 0
+        for p in params:
+            try:
+                with conn.transaction():
+                    n += insert_jobs(cur, [p])
+            except psycopg.Error as e:
+                log(f"💥 insert failed on raw_id={p[1]}: {e}")
+    conn.commit()
+    return n
 
 def main():
     log("🚀 Extract pass started")
-    inserted = 0
+    seen = inserted = 0
     with get_conn() as conn:
+        # вставки — через обычный курсор, пока именованный (with hold) читает
         with conn.cursor() as cur:
-            rows = fetch_unprocessed(cur, limit=500)
-            if not rows:
-                log("😴 No unprocessed raw_items"); return
-            for r in rows:
+            params: List[tuple] = []
+            for r in fetch_unprocessed(conn):
+                seen += 1
                 try:
-                    job_id = insert_job(cur, r)
-                    if job_id:
-                        inserted += 1
+                    params.append(job_params(r))
                 except Exception as e:
                     log(f"💥 failed on raw_id={r['raw_id']}: {e}")
-            conn.commit()
+                if len(params) >= FLUSH_EVERY:
+                    inserted += flush_jobs(conn, cur, params)
+                    params = []
+            inserted += flush_jobs(conn, cur, params)
+    if not seen:
+        log("😴 No unprocessed raw_items"); return
     log(f"✅ Extracted {inserted} job(s)")
 
 if __name__ == "__main__":
@@ -11,15 +11,18 @@ ENV:
 Tables expected (created earlier):
   public.sources(kind,name,url,external_id,...)
   public.raw_items(source_id,external_id,published_at,author,url,text_raw,attachments,... unique (source_id, external_id))
+
+Recommended index (makes the per-source max(message id) lookup an index probe):
+  create index on public.raw_items (source_id, (external_id::bigint)) where external_id ~ '^[0-9]+$';
 """
 
-import os, sys, asyncio, json
+import os, sys, asyncio
 from typing import Optional, AsyncIterator
 from datetime import datetime, timezone
 from dateutil import tz
 
-import psycopg
 from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
 
 from telethon import TelegramClient
 from telethon.sessions import StringSession
@@ -88,12 +91,17 @@ def build_message_url(entity, msg_id: int) -> Optional[str]:
 
 # ----------------------------- DB ops ----------------------------- #
 
-def get_conn():
+# сколько каналов читаем одновременно (и размер пула соединений)
+CHANNEL_CONCURRENCY = 4
+
+def get_pool() -> AsyncConnectionPool:
     db_url = env("DATABASE_URL")
-    return psycopg.connect(db_url, row_factory=dict_row)
+    return AsyncConnectionPool(
+        db_url, min_size=1, max_size=CHANNEL_CONCURRENCY, kwargs={"row_factory": dict_row}, open=False
+    )
 
-def ensure_source(cur, kind: str, name: str, url: str) -> int:
-    cur.execute(
+async def ensure_source(cur, kind: str, name: str, url: str) -> int:
+    await cur.execute(
         """
         select id from public.sources
         where kind = %s and coalesce(url,'') = %s
@@ -101,10 +109,10 @@ def ensure_source(cur, kind: str, name: str, url: str) -> int:
         """,
         (kind, url),
     )
-    row = cur.fetchone()
+    row = await cur.fetchone()
     if row:
         return row["id"]
-    cur.execute(
+    await cur.execute(
         """
         insert into public.sources (kind, name, url)
         values (%s, %s, %s)
@@ -112,41 +120,94 @@ def ensure_source(cur, kind: str, name: str, url: str) -> int:
         """,
         (kind, name, url),
     )
-    return cur.fetchone()["id"]
+    return (await cur.fetchone())["id"]
 
-def max_msg_id(cur, source_id: int) -> int:
-    cur.execute(
+async def max_msg_ids(cur, source_ids: list[int]) -> dict[int, int]:
+    """Last ingested Telegram message id for every source, in one round trip."""
+    if not source_ids:
+        return {}
+    await cur.execute(
         """
-        select coalesce(max((case when external_id ~ '^[0-9]+$' then external_id::bigint else null end)), 0) as max_id
+        select source_id,
+               max(case when external_id ~ '^[0-9]+$' then external_id::bigint end) as max_id
         from public.raw_items
-        where source_id = %s
+        where source_id = any(%s)
+          and external_id ~ '^[0-9]+$'
+        group by source_id
         """,
-        (source_id,),
+        (source_ids,),
     )
-    return int(cur.fetchone()["max_id"] or 0)
+    return {r["source_id"]: int(r["max_id"] or 0) for r in await cur.fetchall()}
 
-def insert_raw(cur, source_id: int, msg: Message, msg_url: Optional[str]) -> Optional[int]:
-    attachments = json.dumps(message_to_attachments(msg))
+RAW_COLS = "source_id, external_id, published_at, author, url, text_raw, attachments"
+
+FLUSH_EVERY = 500
+
+def raw_params(source_id: int, msg: Message, msg_url: Optional[str]) -> tuple:
+    attachments = message_to_attachments(msg)  # dict: binary COPY сам кодирует в jsonb
     published_at = ensure_utc(msg.date)
     author = str(getattr(msg, "sender_id", "") or "")  # 채널 посты могут быть без sender_id
     text_raw = msg.message or ""
-    cur.execute(
-        """
-        insert into public.raw_items
-            (source_id, external_id, published_at, author, url, text_raw, attachments)
-        values
-            (%s, %s, %s, %s, %s, %s, %s)
+    return (source_id, str(msg.id), published_at, author, msg_url, text_raw, attachments)
+
+async def insert_raw_batch(cur, rows: list[tuple]) -> int:
+    """Binary-COPY buffered messages into a temp table, then move new ones to raw_items; returns number of new rows."""
+    if not rows:
+        return 0
+    # CTAS, а не LIKE: без дефолтов (не жжём sequence id) и без NOT NULL
+    await cur.execute(f"create temp table tmp_raw on commit drop as select {RAW_COLS} from public.raw_items limit 0")
+    await cur.execute(f"select {RAW_COLS} from tmp_raw limit 0")
+    types = [c.type_code for c in cur.description]
+    async with cur.copy(f"copy tmp_raw ({RAW_COLS}) from stdin (format binary)") as cp:
+        cp.set_types(types)
+        for r in rows:
+            await cp.write_row(r)
+    await cur.execute(
+        f"""
+        insert into public.raw_items ({RAW_COLS})
+        select {RAW_COLS} from tmp_raw
         on conflict (source_id, external_id) do nothing
-        returning id
-        """,
-        (source_id, str(msg.id), published_at, author, msg_url, text_raw, attachments),
+        """
     )
-    r = cur.fetchone()
-    return r["id"] if r else None
+    inserted = cur.rowcount
+    await cur.execute("drop table tmp_raw")
+    return inserted
 
 
 # ----------------------------- Telegram ingest ----------------------------- #
 
+async def process_channel(
+    client: TelegramClient, pool: AsyncConnectionPool, sem: asyncio.Semaphore,
+    entity, ch_title: str, source_id: int, last_id: int,
+) -> int:
+    """Fetch one channel's new messages into raw_items on its own pooled connection."""
+    async with sem:
+        log(f"📥 {ch_title}: fetching messages > {last_id}")
+        new_cnt = 0
+        buf: list[tuple] = []
+        try:
+            # pool.connection(): commit при успехе, rollback при исключении
+            async with pool.connection() as conn:
+                async with conn.cursor() as cur:
+                    async for m in aiter_messages_safe(client, entity, min_id=last_id):
+                        if not isinstance(m, Message):
+                            continue
+                        if not (m.message or m.media):
+                            continue
+                        msg_url = build_message_url(entity, m.id)
+                        buf.append(raw_params(source_id, m, msg_url))
+                        if len(buf) >= FLUSH_EVERY:
+                            new_cnt += await insert_raw_batch(cur, buf)
+                            buf.clear()
+                            log(f"… {ch_title}: inserted {new_cnt}")
+                    new_cnt += await insert_raw_batch(cur, buf)
+        except Exception as e:
+            log(f"💥 Error while iterating {ch_title}: {e}")
+            return 0
+
+        log(f"✅ {ch_title}: +{new_cnt} new")
+        return new_cnt
+
 async def ingest_telegram() -> None:
     api_id = int(env("TG_API_ID"))
     api_hash = env("TG_API_HASH")
@@ -171,49 +232,34 @@ async def ingest_telegram() -> None:
     me = await client.get_me()
     log(f"🙋 Authorized as: id={getattr(me, 'id', '?')} username={getattr(me, 'username', '') or '—'}")
 
-    total_new = 0
-    with get_conn() as conn:
-        with conn.cursor() as cur:
-            for ch in channels:
-                try:
-                    entity = await client.get_entity(ch)
-                except (ChannelPrivateError, UsernameNotOccupiedError) as e:
-                    log(f"🚫 Cannot access {ch}: {e}")
-                    continue
-                except Exception as e:
-                    log(f"💥 get_entity failed for {ch}: {e}")
-                    continue
-
-                ch_title = getattr(entity, "title", None) or getattr(entity, "username", None) or str(ch)
-                ch_url = f"https://t.me/{getattr(entity, 'username', '')}" if getattr(entity, "username", None) else str(ch)
-
-                # ensure source & get last processed id
-                source_id = ensure_source(cur, "telegram", ch_title, ch_url)
-                last_id = max_msg_id(cur, source_id)
-                log(f"📥 {ch_title}: fetching messages > {last_id}")
-
-                new_cnt = 0
-                try:
-                    async for m in aiter_messages_safe(client, entity, min_id=last_id):
-                        if not isinstance(m, Message):
-                            continue
-                        if not (m.message or m.media):
-                            continue
-                        msg_url = build_message_url(entity, m.id)
-                        inserted_id = insert_raw(cur, source_id, m, msg_url)
-                        if inserted_id:
-                            new_cnt += 1
-                            # логируем прогресс не слишком часто
-                            if new_cnt % 50 == 0:
-                                log(f"… {ch_title}: inserted {new_cnt}")
-                    conn.commit()
-                except Exception as e:
-                    conn.rollback()
-                    log(f"💥 Error while iterating {ch_title}: {e}")
-                    continue
-
-                total_new += new_cnt
-                log(f"✅ {ch_title}: +{new_cnt} new")
+    async with get_pool() as pool:
+        # 1) резолвим каналы и заводим sources, 2) одним запросом берём last id по всем
+        targets = []
+        async with pool.connection() as conn:
+            async with conn.cursor() as cur:
+                for ch in channels:
+                    try:
+                        entity = await client.get_entity(ch)
+                    except (ChannelPrivateError, UsernameNotOccupiedError) as e:
+                        log(f"🚫 Cannot access {ch}: {e}")
+                        continue
+                    except Exception as e:
+                        log(f"💥 get_entity failed for {ch}: {e}")
+                        continue
+
+                    ch_title = getattr(entity, "title", None) or getattr(entity, "username", None) or str(ch)
+                    ch_url = f"https://t.me/{getattr(entity, 'username', '')}" if getattr(entity, "username", None) else str(ch)
+                    source_id = await ensure_source(cur, "telegram", ch_title, ch_url)
+                    targets.append((entity, ch_title, source_id))
+                last_ids = await max_msg_ids(cur, [source_id for _, _, source_id in targets])
+
+        # 3) каналы параллельно, не больше CHANNEL_CONCURRENCY за раз
+        sem = asyncio.Semaphore(CHANNEL_CONCURRENCY)
+        counts = await asyncio.gather(*(
+            process_channel(client, pool, sem, entity, ch_title, source_id, last_ids.get(source_id, 0))
+            for entity, ch_title, source_id in targets
+        ))
+    total_new = sum(counts)
 
     await client.disconnect()
     log(f"🎯 Telegram ingest done. New raw_items: {total_new}")
@@ -1,4 +1,4 @@
-import os, sys, json
+import os, sys, json, time
 from datetime import datetime, timezone
 from typing import Optional, Dict, Any, List
 import socket
@@ -7,10 +7,19 @@ import urllib.parse as urlparse
 import requests
 import psycopg
 from psycopg.rows import dict_row
+from psycopg.types.json import Jsonb
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+
+try:
+    from app.db import prepare_threshold_from_env
+except ImportError:  # запуск скриптом: app/ уже в sys.path
+    from db import prepare_threshold_from_env
+
+UTC = timezone.utc
 
 
 def log(msg: str):
-    now = datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S")
+    now = datetime.now(UTC).strftime("%Y-%m-%d %H:%M:%S")
     print(f"[{now} UTC] {msg}", flush=True)
 
 def env(name: str, required=True, default=None) -> str:
@@ -20,73 +29,102 @@ def env(name: str, required=True, default=None) -> str:
     return v
 
 
+# окружение читаем один раз при старте
+DATABASE_URL = env("DATABASE_URL")
+TG_BOT_TOKEN = env("TG_BOT_TOKEN")
+ALLOWED_CHAT_IDS = frozenset(
+    s.strip() for s in os.getenv("ALLOWED_CHAT_IDS", "").replace("\n", ",").split(",") if s.strip()
+) or None
+
+
 # ---------------- DB helpers ----------------
 
+# 0 — серверный prepared statement с первого выполнения (INSERT в raw_items повторяется
+# на каждой пачке); "none" отключает — нужно за pgbouncer в transaction mode
+PREPARE_THRESHOLD = prepare_threshold_from_env()
+
 def db():
-    dsn = env("DATABASE_URL")
+    dsn = DATABASE_URL
     try:
         parsed = urlparse.urlparse(dsn)
         host = parsed.hostname
         port = parsed.port or 5432
         # берём IPv4-адрес (A-запись) и передаём его как hostaddr
         ipv4 = socket.getaddrinfo(host, port, family=socket.AF_INET)[0][4][0]
-        return psycopg.connect(dsn, row_factory=dict_row, hostaddr=ipv4)
+        return psycopg.connect(dsn, row_factory=dict_row, hostaddr=ipv4, prepare_threshold=PREPARE_THRESHOLD)
     except Exception as e:
         log(f"⚠️ IPv4 fallback failed ({e}), trying default connect()")
-        return psycopg.connect(dsn, row_factory=dict_row)
+        return psycopg.connect(dsn, row_factory=dict_row, prepare_threshold=PREPARE_THRESHOLD)
+
 
+def load_sources(cur) -> Dict[str, int]:
+    # external_id → id для всех telegram-источников; каналов мало, грузим разом
+    cur.execute("select external_id, id from public.sources where kind='telegram' and external_id is not null order by id desc")
+    return {r["external_id"]: r["id"] for r in cur.fetchall()}
 
-def ensure_source(cur, chat: Dict[str, Any]) -> int:
+def ensure_source(cur, chat: Dict[str, Any], src_map: Dict[str, int]) -> int:
     chat_id = str(chat["id"])
+    sid = src_map.get(chat_id)
+    if sid is not None:
+        return sid
     name = chat.get("title") or chat.get("username") or chat_id
     url = f"https://t.me/{chat.get('username')}" if chat.get("username") else ""
-    cur.execute("select id from public.sources where kind='telegram' and external_id=%s limit 1", (chat_id,))
-    r = cur.fetchone()
-    if r: return r["id"]
     cur.execute(
         "insert into public.sources (kind,name,url,external_id) values ('telegram', %s, %s, %s) returning id",
         (name, url, chat_id),
     )
-    return cur.fetchone()["id"]
+    sid = src_map[chat_id] = cur.fetchone()["id"]
+    return sid
 
-def insert_raw(cur, source_id: int, message: Dict[str, Any], username: Optional[str]) -> Optional[int]:
-    msg_id = message["message_id"]
+INSERT_RAW_SQL = """
+  insert into public.raw_items
+    (source_id, external_id, published_at, author, url, text_raw, attachments)
+  values
+    (%s, %s, coalesce(to_timestamp(%s), now()), %s, %s, %s, %s)
+  on conflict (source_id, external_id) do nothing
+"""
+
+MEDIA_KEYS = ("photo", "document", "video", "audio", "sticker")
+
+def message_text(message: Dict[str, Any]) -> Optional[str]:
+    # None — сохранять нечего: нет ни текста, ни подписи, и это не часть альбома
     text = message.get("text") or message.get("caption") or ""
     if not text and not message.get("media_group_id"):
         return None
+    return text
+
+def raw_params(source_id: int, message: Dict[str, Any], username: Optional[str], text: str) -> tuple:
+    msg_id = message["message_id"]
 
-    # date приходит Unix-временем
-    unix_ts = message.get("date")
-    published_at = datetime.fromtimestamp(unix_ts, tz=timezone.utc) if unix_ts else datetime.now(timezone.utc)
+    # date приходит Unix-временем — отдаём как есть, в timestamptz переводит to_timestamp() в SQL
+    unix_ts = message.get("date") or None
     author = str(message.get("author_signature") or "")
     url = f"https://t.me/{username}/{msg_id}" if username else None
 
+    media_types = [k for k in MEDIA_KEYS if k in message]
     attachments = {
-        "has_media": any(k in message for k in ("photo", "document", "video", "audio", "sticker")),
-        "media_types": [k for k in ("photo","document","video","audio","sticker") if k in message],
+        "has_media": bool(media_types),
+        "media_types": media_types,
         "fwd_from": bool(message.get("forward_from") or message.get("forward_from_chat")),
         "entities": [e.get("type") for e in message.get("entities", [])],
         "caption_entities": [e.get("type") for e in message.get("caption_entities", [])],
     }
 
-    cur.execute("""
-      insert into public.raw_items
-        (source_id, external_id, published_at, author, url, text_raw, attachments)
-      values
-        (%s, %s, %s, %s, %s, %s, %s)
-      on conflict (source_id, external_id) do nothing
-      returning id
-    """, (
+    return (
         source_id,
         str(msg_id),              # уникальность: (source_id, external_id)
-        published_at,
+        unix_ts,                  # published_at; нет даты — now()
         author,
         url,
         text,
-        json.dumps(attachments),
-    ))
-    r = cur.fetchone()
-    return r["id"] if r else None
+        Jsonb(attachments),
+    )
+
+def insert_raw_batch(cur, rows: List[tuple]):
+    # одна пачка executemany вместо INSERT ... RETURNING на каждое сообщение;
+    # в pipeline cur.rowcount готов только после sync — читает вызывающий
+    if rows:
+        cur.executemany(INSERT_RAW_SQL, rows)
 
 def get_last_update_id(cur) -> int:
     cur.execute("select last_update_id from public.bot_state where id=1")
@@ -99,15 +137,40 @@ def set_last_update_id(cur, update_id: int):
 
 # ---------------- Telegram Bot API ----------------
 
-def tg_get_updates(token: str, offset: int) -> List[Dict[str, Any]]:
+# long polling: первый запрос ждёт новых апдейтов до POLL_TIMEOUT секунд,
+# дальше дочитываем очередь с timeout=0, пока приходят полные пачки
+POLL_TIMEOUT = int(os.getenv("TG_POLL_TIMEOUT", "25"))
+UPDATES_LIMIT = 100  # максимум Bot API на один getUpdates
+
+# одна сессия на весь прогон: дренирующие запросы идут по тому же keep-alive TLS-соединению
+_session = requests.Session()
+
+class RetryAfter(Exception):
+    """429 от Bot API: подождали parameters.retry_after, запрос надо повторить."""
+
+
+@retry(
+    retry=retry_if_exception_type((RetryAfter, requests.ConnectionError, requests.Timeout)),
+    wait=wait_exponential_jitter(1, 10),
+    stop=stop_after_attempt(3),
+    reraise=True,
+)
+def tg_get_updates(token: str, offset: int, timeout: int = POLL_TIMEOUT) -> List[Dict[str, Any]]:
     url = f"https://api.telegram.org/bot{token}/getUpdates"
     params = {
         "offset": offset,
-        "limit": 100,
-        "timeout": 0,
-        # "allowed_updates": json.dumps(["channel_post"])  # можно указать, но не обязательно
+        "limit": UPDATES_LIMIT,
+        "timeout": timeout,
+        # всё, кроме channel_post, мы всё равно отбрасываем
+        "allowed_updates": json.dumps(["channel_post"]),
     }
-    r = requests.get(url, params=params, timeout=25)
+    # HTTP-таймаут должен быть больше long-poll ожидания
+    r = _session.get(url, params=params, timeout=timeout + 10)
+    if r.status_code == 429:
+        retry_after = int(((r.json().get("parameters") or {}).get("retry_after")) or 1)
+        log(f"⏳ getUpdates rate limited, sleeping {retry_after}s")
+        time.sleep(retry_after)
+        raise RetryAfter(retry_after)
     r.raise_for_status()
     data = r.json()
     if not data.get("ok"):
@@ -117,52 +180,70 @@ def tg_get_updates(token: str, offset: int) -> List[Dict[str, Any]]:
 
 def main():
     log("🚀 Bot poll started")
-    token = env("TG_BOT_TOKEN")
-    allowed = [s.strip() for s in os.getenv("ALLOWED_CHAT_IDS", "").replace("\n", ",").split(",") if s.strip()]
-    allowed_set = set(allowed) if allowed else None
-    if allowed_set:
-        log(f"🔒 ALLOWED_CHAT_IDS set: {', '.join(allowed)}")
+    if ALLOWED_CHAT_IDS:
+        log(f"🔒 ALLOWED_CHAT_IDS set: {', '.join(sorted(ALLOWED_CHAT_IDS))}")
     else:
         log("🔓 ALLOWED_CHAT_IDS not set — примем все channel_post и выведем chat_id в логах.")
 
     with db() as conn:
-        with conn.cursor() as cur:
+        with conn.cursor() as cur, conn.cursor() as ins:
             offset = get_last_update_id(cur) + 1
-            updates = tg_get_updates(token, offset)
-            if not updates:
-                log("😴 No new updates"); return
-
+            src_map = load_sources(cur)
             total_new = 0
             max_update_id = 0
-
-            for upd in updates:
-                max_update_id = max(max_update_id, int(upd["update_id"]))
-
-                msg = upd.get("channel_post")
-                if not msg:
-                    # игнорируем лички/группы/инлайн и т.п.
-                    continue
-
-                chat = msg["chat"]  # {'id':..., 'title':..., 'type':'channel', 'username':?}
-                if chat.get("type") != "channel":
-                    continue
-
-                chat_id = str(chat["id"])
-                if allowed_set and chat_id not in allowed_set:
-                    log(f"↩️  Skip chat_id={chat_id} (not in ALLOWED_CHAT_IDS)")
-                    continue
-
-                # один раз в лог — чтобы узнать chat_id канала
-                log(f"📡 channel_post from chat_id={chat_id} title={chat.get('title')} username={chat.get('username')}")
-
-                source_id = ensure_source(cur, chat)
-                inserted = insert_raw(cur, source_id, msg, chat.get("username"))
-                if inserted:
-                    total_new += 1
-
-            if max_update_id:
-                set_last_update_id(cur, max_update_id)
-            conn.commit()
+            timeout = POLL_TIMEOUT
+
+            while True:
+                updates = tg_get_updates(TG_BOT_TOKEN, offset, timeout)
+                if not updates:
+                    break
+                timeout = 0
+                rows: List[tuple] = []
+                # update_id в ответе Bot API уже int
+                max_update_id = max(max_update_id, max((u["update_id"] for u in updates), default=0))
+
+                for upd in updates:
+                    msg = upd.get("channel_post")
+                    if not msg:
+                        # игнорируем лички/группы/инлайн и т.п.
+                        continue
+
+                    chat = msg["chat"]  # {'id':..., 'title':..., 'type':'channel', 'username':?}
+                    if chat.get("type") != "channel":
+                        continue
+
+                    chat_id = str(chat["id"])
+                    if ALLOWED_CHAT_IDS and chat_id not in ALLOWED_CHAT_IDS:
+                        log(f"↩️  Skip chat_id={chat_id} (not in ALLOWED_CHAT_IDS)")
+                        continue
+
+                    # один раз в лог — чтобы узнать chat_id канала
+                    log(f"📡 channel_post from chat_id={chat_id} title={chat.get('title')} username={chat.get('username')}")
+
+                    # пустые посты отсекаем до любых обращений к БД
+                    text = message_text(msg)
+                    if text is None:
+                        continue
+
+                    source_id = ensure_source(cur, chat, src_map)
+                    rows.append(raw_params(source_id, msg, chat.get("username"), text))
+
+                # запрос со следующим offset подтверждает пачку у Telegram —
+                # поэтому фиксируем её в БД до того, как читать дальше.
+                # вставка, сдвиг offset и commit — одним pipeline: один sync вместо трёх
+                with conn.pipeline():
+                    insert_raw_batch(ins, rows)
+                    set_last_update_id(cur, max_update_id)
+                    conn.commit()
+                if rows:
+                    total_new += ins.rowcount
+                # неполная пачка — очередь у Telegram пуста, лишний пустой запрос не нужен
+                if len(updates) < UPDATES_LIMIT:
+                    break
+                offset = max_update_id + 1
+
+            if not max_update_id:
+                log("😴 No new updates"); return
 
             log(f"✅ Done. New raw_items inserted: {total_new}. Last update_id={max_update_id}")
 
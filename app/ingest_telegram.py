@@ -1,27 +1,38 @@
 import os
-import re
 import asyncio
-from datetime import timezone
 from typing import Optional, Tuple, Any, Dict
 
 import psycopg
 from psycopg.rows import dict_row
+from psycopg_pool import AsyncConnectionPool
 from telethon import TelegramClient
+from telethon.errors import FloodWaitError
 from telethon.sessions import StringSession
 from telethon.tl.types import Message
-from tenacity import retry, stop_after_attempt, wait_exponential_jitter
+
+try:
+    from app.db import prepare_threshold_from_env
+except ImportError:  # запуск скриптом: app/ уже в sys.path
+    from db import prepare_threshold_from_env
 
 DATABASE_URL = os.environ["DATABASE_URL"]
 TG_API_ID = int(os.environ["TG_API_ID"])
 TG_API_HASH = os.environ["TG_API_HASH"]
 TG_STRING_SESSION = os.environ["TG_STRING_SESSION"]
+PREPARE_THRESHOLD = prepare_threshold_from_env()
+# сколько источников читаем одновременно (и размер пула соединений)
+SOURCE_CONCURRENCY = int(os.getenv("TG_SOURCE_CONCURRENCY", "8"))
 
 # ---- DB helpers -------------------------------------------------------------
 
-@retry(wait=wait_exponential_jitter(1, 5), stop=stop_after_attempt(5))
-async def _get_conn():
-    # psycopg 3 умеет async
-    return await psycopg.AsyncConnection.connect(DATABASE_URL, autocommit=True)
+def get_pool() -> AsyncConnectionPool:
+    # по соединению на параллельный источник; пул сам переподключается при обрывах.
+    # без autocommit: pool.connection() коммитит при выходе, откатывает при исключении
+    return AsyncConnectionPool(
+        DATABASE_URL, min_size=1, max_size=SOURCE_CONCURRENCY,
+        kwargs={"prepare_threshold": PREPARE_THRESHOLD},
+        open=False,
+    )
 
 async def fetch_sources(conn) -> list[Dict[str, Any]]:
     q = """
@@ -46,29 +57,45 @@ async def get_cursor(conn, source_id: int) -> Optional[int]:
         except ValueError:
             return None
 
-async def set_cursor(conn, source_id: int, message_id: int):
-    q = """
+async def set_cursors(conn, cursors: list[Tuple[int, int]]):
+    # одним multi-row upsert по всем источникам прогона
+    if not cursors:
+        return
+    q = f"""
     insert into public.ingest_cursors (source_id, cursor_text, updated_at)
-    values (%s, %s, now())
+    values {", ".join(["(%s, %s, now())"] * len(cursors))}
     on conflict (source_id) do update
       set cursor_text = excluded.cursor_text, updated_at = now();
     """
+    params = [v for sid, message_id in cursors for v in (sid, str(message_id))]
     async with conn.cursor() as cur:
-        await cur.execute(q, (source_id, str(message_id)))
+        await cur.execute(q, params)
 
 async def upsert_source_external_id(conn, source_id: int, external_id: str):
     q = "update public.sources set external_id = %s where id = %s"
     async with conn.cursor() as cur:
         await cur.execute(q, (external_id, source_id))
 
-async def insert_raw_item(conn, source_id: int, m: Message, url_guess: Optional[str]):
-    q = """
-    insert into public.raw_items
-      (source_id, external_id, published_at, fetched_at, author, url, text_raw, attachments)
-    values
-      (%s, %s, %s, now(), %s, %s, %s, %s)
-    on conflict (source_id, external_id) do nothing
-    """
+INSERT_RAW_SQL = """
+insert into public.raw_items
+  (source_id, external_id, published_at, fetched_at, author, url, text_raw, attachments)
+values
+  (%s, %s, %s, now(), %s, %s, %s, %s)
+on conflict (source_id, external_id) do nothing
+"""
+
+# сообщений на один executemany; iter_messages тянет историю страницами по 100,
+# так что запись пачки идёт, пока грузится следующая страница
+FLUSH_EVERY = 100
+# пауза между страницами истории; не задана — решает Telethon (1 с при limit > 3000,
+# т.е. на каждом инкрементальном прогоне). источники читаются параллельно на одном клиенте,
+# так что пауза не лишняя: без неё проще нарваться на FloodWait
+_hw = os.getenv("TG_HISTORY_WAIT")
+HISTORY_WAIT = float(_hw) if _hw else None
+# FloodWait дольше flood_sleep_threshold Telethon пробрасывает: ждём сами и читаем источник заново
+FLOOD_RETRIES = int(os.getenv("TG_FLOOD_RETRIES", "2"))
+
+def raw_item_params(source_id: int, m: Message, url_guess: Optional[str]) -> tuple:
     text = m.message or ""
     author = str(m.sender_id) if getattr(m, "sender_id", None) else None
 
@@ -77,37 +104,47 @@ async def insert_raw_item(conn, source_id: int, m: Message, url_guess: Optional[
     if m.media:
         attach.append(type(m.media).__name__)
 
-    attachments_json = psycopg.types.json.Jsonb(attach)
-
+    return (
+        source_id,
+        str(m.id),                        # external_id = message_id
+        m.date,                           # published_at; Telethon отдаёт aware-datetime в UTC
+        author,
+        url_guess,
+        text,
+        psycopg.types.json.Jsonb(attach),
+    )
+
+async def insert_raw_items(conn, rows: list[tuple]) -> int:
+    if not rows:
+        return 0
     async with conn.cursor() as cur:
-        await cur.execute(
-            q,
-            (
-                source_id,
-                str(m.id),                        # external_id = message_id
-                m.date.astimezone(timezone.utc),  # published_at
-                author,
-                url_guess,
-                text,
-                attachments_json,
-            ),
-        )
+        await cur.executemany(INSERT_RAW_SQL, rows)
+        return cur.rowcount
 
 # ---- Telegram helpers -------------------------------------------------------
 
-_username_re = re.compile(r"https?://t\.me/(@?)([A-Za-z0-9_]+)/?$")
+_TME_PREFIXES = ("https://t.me/", "http://t.me/")
+
+def _public_username(source_url: str) -> Optional[str]:
+    # https://t.me/<username>[/] или https://t.me/@<username>; инвайты (+..., joinchat/...) — не публичные
+    s = source_url.strip()
+    if not s.startswith(_TME_PREFIXES):
+        return None
+    name = s.partition("t.me/")[2]
+    name = name[:-1] if name.endswith("/") else name
+    name = name[1:] if name.startswith("@") else name
+    if name and all(c.isascii() and (c.isalnum() or c == "_") for c in name):
+        return name
+    return None
 
 async def resolve_entity_and_url_hint(client: TelegramClient, source_url: str) -> Tuple[Any, Optional[str]]:
     """
     Вернём entity для Telethon и шаблон публичной ссылки 'https://t.me/<username>'
     (если у канала есть username). Для приватных вернётся None как url_hint.
     """
-    m = _username_re.match(source_url.strip())
+    username = _public_username(source_url)
     entity = await client.get_entity(source_url)
-    url_hint = None
-    if m:
-        username = m.group(2).lstrip("@")
-        url_hint = f"https://t.me/{username}"
+    url_hint = f"https://t.me/{username}" if username else None
     return entity, url_hint
 
 def message_public_url(url_hint: Optional[str], message_id: int) -> Optional[str]:
@@ -117,52 +154,98 @@ def message_public_url(url_hint: Optional[str], message_id: int) -> Optional[str
 
 # ---- Main ingest ------------------------------------------------------------
 
-async def ingest_telegram():
-    print("🔎 Starting Telegram ingest...")
-    conn = await _get_conn()
-    sources = await fetch_sources(conn)
-    if not sources:
-        print("ℹ️ Нет источников kind=telegram в таблице sources. Добавь их и перезапусти.")
-        await conn.close()
-        return
-
-    async with TelegramClient(StringSession(TG_STRING_SESSION), TG_API_ID, TG_API_HASH) as client:
-        for s in sources:
-            sid, surl, sname, s_ext_id = s["id"], s["url"], s["name"], s["external_id"]
-            print(f"— Обрабатываю [{sid}] {sname} :: {surl}")
-
+async def process_source(
+    client: TelegramClient, pool: AsyncConnectionPool, sem: asyncio.Semaphore, s: Dict[str, Any]
+) -> Optional[Tuple[int, int]]:
+    # вернёт (source_id, новый курсор), если он сдвинулся; сами курсоры пишет ingest_telegram
+    sid, surl, sname = s["id"], s["url"], s["name"]
+    async with sem:
+        print(f"— Обрабатываю [{sid}] {sname} :: {surl}")
+        for attempt in range(FLOOD_RETRIES + 1):
             try:
-                entity, url_hint = await resolve_entity_and_url_hint(client, surl)
-                # сохраним numeric channel id в external_id (для удобства дедупа/отладки)
-                try:
-                    await upsert_source_external_id(conn, sid, str(entity.id))
-                except Exception:
-                    pass
-
-                min_id = await get_cursor(conn, sid)
-                # Первую историю ограничим, чтобы не «утонуть»
-                # Если курсора нет — возьмём только последние 200 сообщений
-                limit_first = 200 if min_id is None else None
-
-                newest_seen = min_id or 0
-                async for msg in client.iter_messages(entity, min_id=min_id, reverse=True, limit=limit_first):
-                    if not isinstance(msg, Message):
-                        continue
-                    url = message_public_url(url_hint, msg.id)
-                    await insert_raw_item(conn, sid, msg, url)
-                    if msg.id > newest_seen:
-                        newest_seen = msg.id
-
-                if newest_seen and newest_seen != (min_id or 0):
-                    await set_cursor(conn, sid, newest_seen)
-                    print(f"  ✔ Обновил курсор: {min_id} → {newest_seen}")
-                else:
-                    print("  ✔ Новых сообщений нет")
-
+                return await read_source(client, pool, s)
+            except FloodWaitError as e:
+                # транзакция источника откатилась вместе с исключением — повтор начинается с того же курсора
+                if attempt == FLOOD_RETRIES:
+                    print(f"  ⚠️ {sname}: FloodWait {e.seconds} с, попытки кончились")
+                    break
+                print(f"  ⏳ {sname}: FloodWait {e.seconds} с — жду и читаю заново")
+                await asyncio.sleep(e.seconds + 1)
             except Exception as e:
                 print(f"  ⚠️ Ошибка на источнике {sname}: {e}")
+                break
+        return None
+
+async def read_source(
+    client: TelegramClient, pool: AsyncConnectionPool, s: Dict[str, Any]
+) -> Optional[Tuple[int, int]]:
+    sid, surl, sname = s["id"], s["url"], s["name"]
+    # строки источника — одной транзакцией; курсор пишется уже после её коммита,
+    # так что он никогда не убегает вперёд записанных строк
+    async with pool.connection() as conn:
+        entity, url_hint = await resolve_entity_and_url_hint(client, surl)
+        # сохраним numeric channel id в external_id (для удобства дедупа/отладки);
+        # отдельной короткой транзакцией: id сохраняется, даже если чтение ниже упадёт,
+        # а сбой здесь не ломает транзакцию источника
+        try:
+            async with conn.transaction():
+                await upsert_source_external_id(conn, sid, str(entity.id))
+        except Exception:
+            pass
+
+        min_id = await get_cursor(conn, sid)
+        # Первую историю ограничим, чтобы не «утонуть»
+        # Если курсора нет — возьмём только последние 200 сообщений
+        limit_first = 200 if min_id is None else None
+
+        newest_seen = min_id or 0
+        rows: list[tuple] = []
+        # предыдущая пачка пишется в фоне; на одном соединении — не больше одной за раз
+        flush: Optional[asyncio.Task] = None
+        try:
+            async for msg in client.iter_messages(
+                entity, min_id=min_id, reverse=True, limit=limit_first, wait_time=HISTORY_WAIT
+            ):
+                if not isinstance(msg, Message):
+                    continue
+                url = message_public_url(url_hint, msg.id)
+                rows.append(raw_item_params(sid, msg, url))
+                if msg.id > newest_seen:
+                    newest_seen = msg.id
+                if len(rows) >= FLUSH_EVERY:
+                    if flush:
+                        await flush
+                    flush = asyncio.create_task(insert_raw_items(conn, rows))
+                    rows = []
+        finally:
+            if flush:
+                await flush
+        await insert_raw_items(conn, rows)
+
+    if newest_seen and newest_seen != (min_id or 0):
+        print(f"  ✔ {sname}: курсор {min_id} → {newest_seen}")
+        return sid, newest_seen
+    print(f"  ✔ {sname}: новых сообщений нет")
+    return None
+
+async def ingest_telegram():
+    print("🔎 Starting Telegram ingest...")
+    async with get_pool() as pool:
+        async with pool.connection() as conn:
+            sources = await fetch_sources(conn)
+        if not sources:
+            print("ℹ️ Нет источников kind=telegram в таблице sources. Добавь их и перезапусти.")
+            return
+
+        # один TelegramClient на все источники (Telethon мультиплексирует запросы),
+        # источники — параллельно, не больше SOURCE_CONCURRENCY за раз
+        async with TelegramClient(StringSession(TG_STRING_SESSION), TG_API_ID, TG_API_HASH) as client:
+            sem = asyncio.Semaphore(SOURCE_CONCURRENCY)
+            moved = await asyncio.gather(*(process_source(client, pool, sem, s) for s in sources))
+
+        async with pool.connection() as conn:
+            await set_cursors(conn, [c for c in moved if c])
 
-    await conn.close()
     print("✅ Telegram ingest завершён")
 
 if __name__ == "__main__":
@@ -5,26 +5,56 @@ from __future__ import annotations
 
 import argparse
 import asyncio
+import bisect
+import hashlib
 import json
 import math
 import os
 import re
 import time
+from collections import OrderedDict
+from functools import lru_cache
 from pathlib import Path
-from typing import Any, Dict, List, Optional, Tuple
+from typing import Any, Dict, List, Optional, Sequence, Tuple
 
 import httpx
 from dotenv import load_dotenv, find_dotenv
 from pydantic import BaseModel, Field, model_validator
 from rapidfuzz import fuzz, process
-from supabase import Client, create_client  # type: ignore
-from tenacity import retry, stop_after_attempt, wait_exponential_jitter
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 
-# информативные ошибки Supabase (опционально)
 try:
-    from postgrest import APIError as PostgrestAPIError  # type: ignore
+    from app.db import prepare_threshold_from_env
+except ImportError:  # запуск скриптом: app/ уже в sys.path
+    from db import prepare_threshold_from_env
+
+# прямое подключение к Postgres (опционально, при DATABASE_URL)
+try:
+    from psycopg import OperationalError as PgOperationalError, sql
+    from psycopg_pool import AsyncConnectionPool
+except Exception:  # pragma: no cover
+    PgOperationalError = OSError  # type: ignore
+    sql = None  # type: ignore
+    AsyncConnectionPool = None  # type: ignore
+
+# быстрый JSON (опционально): ответы LLM и тела запросов к Ollama
+try:
+    import orjson
+except Exception:  # pragma: no cover
+    orjson = None  # type: ignore
+
+# быстрый сканер ключевых слов (опционально; без него — регулярки rule_enrich без префильтра)
+try:
+    import ahocorasick  # type: ignore
 except Exception:  # pragma: no cover
-    PostgrestAPIError = Exception  # type: ignore
+    ahocorasick = None  # type: ignore
+
+# HTTP/2 для httpx (опционально, пакет h2): параллельные запросы к одному https-хосту — по одному соединению
+try:
+    import h2  # type: ignore  # noqa: F401
+    HAS_H2 = True
+except Exception:  # pragma: no cover
+    HAS_H2 = False
 
 # -------- pretty console (rich) --------
 HAS_RICH = True
@@ -61,11 +91,26 @@ load_dotenv(Path(__file__).with_name(".env"), override=False)
 rich_traceback_install(show_locals=False)
 
 # ---------------- Утилиты ----------------
+RICH_TAG_RE = re.compile(r"\[/?[a-z]+\]")
+JSON_OBJ_RE = re.compile(r"\{[\s\S]*\}")  # от первой { до последней } — JSON в ответе LLM с мусором вокруг
+
+def json_loads(s: Any) -> Any:
+    # str или bytes; ошибка разбора — json.JSONDecodeError (у orjson — его подкласс)
+    return orjson.loads(s) if orjson else json.loads(s)
+
+def json_dumps(obj: Any) -> bytes:
+    # компактно и в UTF-8 — как json= у httpx
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
 def pretty_print(msg: str) -> None:
     if (os.getenv("PRETTY", "1") != "0") and HAS_RICH and Console:
         Console().print(msg)  # type: ignore
     else:
-        print(re.sub(r"\[/?[a-z]+\]", "", msg))
+        print(RICH_TAG_RE.sub("", msg))
 
 
 def env_get(*names: str, default: Optional[str] = None) -> Optional[str]:
@@ -85,6 +130,15 @@ RAW_TABLE = os.getenv("SUPABASE_RAW_TABLE", "v_jobs_input")
 
 PARSED_TABLE = os.getenv("SUPABASE_PARSED_TABLE", "jobs")
 RAW_TEXT_FIELD = os.getenv("RAW_TEXT_FIELD", "text_raw")
+# какие колонки читать из RAW_TABLE — только те, что нужны parse_one/build_record; "*" — все
+RAW_COLUMNS = [c.strip() for c in os.getenv(
+    "RAW_COLUMNS", f"raw_id,source_id,author,published_at,fetched_at,{RAW_TEXT_FIELD}"
+).split(",") if c.strip()]
+
+# если задан DATABASE_URL — читаем и пишем батчи напрямую в Postgres через пул, минуя PostgREST
+DATABASE_URL = os.getenv("DATABASE_URL")
+PG_POOL_MAX = int(os.getenv("PG_POOL_MAX", "10"))  # у Supabase по умолчанию не больше 15 соединений на проект
+PREPARE_THRESHOLD = prepare_threshold_from_env()
 
 # failover: сначала облако, затем локально
 CLOUD_MODEL = env_get("OLLAMA_CLOUD_MODEL", "CLOUD_MODEL")
@@ -93,21 +147,83 @@ CLOUD_API_KEY = env_get("OLLAMA_CLOUD_API_KEY", "CLOUD_API_KEY")
 
 LOCAL_MODEL = env_get("OLLAMA_MODEL", "LLM_MODEL", "MODEL", default="qwen2.5:7b-instruct")
 LOCAL_HOST = env_get("OLLAMA_HOST", "LLM_HOST", default="http://127.0.0.1:11434").rstrip("/")
+# несколько локальных Ollama через запятую: строки расходятся по наименее загруженному; пусто — один LOCAL_HOST
+LOCAL_HOSTS = [h.strip().rstrip("/") for h in os.getenv("OLLAMA_HOSTS", "").split(",") if h.strip()] or [LOCAL_HOST]
+# на сколько секунд убирать из ротации хост, который не ответил (сбой соединения или 5xx)
+HOST_COOLDOWN_SECONDS = float(os.getenv("OLLAMA_HOST_COOLDOWN_SECONDS", "30"))
 
 # thinking-валидатор (опционально)
 ENABLE_VALIDATOR = os.getenv("ENABLE_VALIDATOR", "1") != "0"
 VALIDATOR_MODEL = os.getenv("VALIDATOR_MODEL", "")
 VALIDATOR_HOST = env_get("VALIDATOR_HOST", default=LOCAL_HOST).rstrip("/")
+# сколько секунд верить последней проверке валидатора (и держать его выключенным после сбоя)
+VALIDATOR_RECHECK_SECONDS = float(os.getenv("VALIDATOR_RECHECK_SECONDS", "60"))
+# через сколько секунд после переключения на локальную модель снова пробовать облако; 0 — никогда
+CLOUD_RETRY_SECONDS = float(os.getenv("CLOUD_RETRY_SECONDS", "600"))
+
+# потолок генерации: одна «зациклившаяся» модель не держит весь батч до таймаута.
+# в ответе есть text_clean (почти весь текст поста), так что запас нужен с головой
+LLM_NUM_PREDICT = int(os.getenv("LLM_NUM_PREDICT", "2048"))
+LLM_NUM_CTX = int(os.getenv("LLM_NUM_CTX", "8192"))
+# read: при LLM_STREAM=1 — между кусочками стрима, без стрима — на весь ответ
+LLM_READ_TIMEOUT = float(os.getenv("LLM_READ_TIMEOUT", "60"))
+LLM_OPTIONS = {"num_ctx": LLM_NUM_CTX, "num_predict": LLM_NUM_PREDICT, "temperature": 0}
+# 1 — стрим ndjson (read-таймаут между кусочками, ранний выход после JSON) — удобно для отладки;
+# по умолчанию ответ одним JSON: без разбора каждого кусочка, соединение сразу освобождается
+LLM_STREAM = os.getenv("LLM_STREAM", "0") == "1"
+# сколько Ollama держит модель в памяти после запроса (по умолчанию у неё 5m — между батчами выгружает)
+LLM_KEEP_ALIVE = os.getenv("LLM_KEEP_ALIVE", "1h")
+# format: JSON-схема ParsedItem (Ollama >= 0.5 держит ответ строго в ней); 0 — просто "json"
+LLM_SCHEMA = os.getenv("LLM_SCHEMA", "1") != "0"
+
+# сколько последних ответов LLM помнить: один пост, разосланный по нескольким каналам, разбираем один раз
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "2048"))
 
 BATCH_SIZE = int(os.getenv("BATCH_SIZE", "5"))
+# сколько строк батча одновременно в работе у LLM: большой BATCH_SIZE не заваливает Ollama разом
+LLM_CONCURRENCY = max(1, int(os.getenv("LLM_CONCURRENCY", "4")))
 POLL_SECONDS = int(os.getenv("POLL_SECONDS", "10"))
 USE_PRETTY = (os.getenv("PRETTY", "1") != "0") and HAS_RICH
 
-if not SUPABASE_URL or not SUPABASE_KEY:
-    raise SystemExit("⛔ Нужны SUPABASE_URL и SUPABASE_SERVICE_ROLE_KEY в .env")
+if DATABASE_URL and AsyncConnectionPool is None:
+    raise SystemExit("⛔ Для DATABASE_URL нужен psycopg[pool]: pip install 'psycopg[binary,pool]'")
+if not DATABASE_URL and (not SUPABASE_URL or not SUPABASE_KEY):
+    raise SystemExit("⛔ Нужны DATABASE_URL или SUPABASE_URL и SUPABASE_SERVICE_ROLE_KEY в .env")
+
+# ---------------- Supabase (PostgREST) client ----------------
+# PostgREST напрямую через async httpx: supabase-py синхронный и блокировал бы event loop
+_REST: Optional[httpx.AsyncClient] = None
+
+def _rest() -> httpx.AsyncClient:
+    global _REST
+    if _REST is None or _REST.is_closed:
+        _REST = httpx.AsyncClient(
+            base_url=f"{SUPABASE_URL.rstrip('/')}/rest/v1",
+            headers={"apikey": SUPABASE_KEY, "Authorization": f"Bearer {SUPABASE_KEY}"},
+            timeout=httpx.Timeout(30.0, connect=5.0),
+            limits=httpx.Limits(max_keepalive_connections=20),
+            http2=HAS_H2,
+        )
+    return _REST
+
+async def close_rest() -> None:
+    global _REST
+    if _REST is not None:
+        await _REST.aclose()
+        _REST = None
 
-# ---------------- Supabase client ----------------
-sb: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+def _rest_check(r: httpx.Response) -> None:
+    if r.is_error:
+        try:
+            e = json_loads(r.content)
+        except Exception:
+            e = {}
+        if isinstance(e, dict):
+            pretty_print(
+                f"[red]Supabase APIError[/] code={e.get('code')} "
+                f"msg={e.get('message')} hint={e.get('hint')} details={e.get('details')}"
+            )
+        r.raise_for_status()
 
 # ---------------- Pydantic схемы ----------------
 class Salary(BaseModel):
@@ -162,25 +278,59 @@ class ParsedItem(BaseModel):
     errors: List[str] = Field(default_factory=list)
 
 
+def _inline_refs(node: Any, defs: Dict[str, Any]) -> Any:
+    # $ref → само определение: грамматике Ollama проще плоская схема
+    if isinstance(node, dict):
+        if "$ref" in node:
+            return _inline_refs(defs[node["$ref"].rsplit("/", 1)[-1]], defs)
+        return {k: _inline_refs(v, defs) for k, v in node.items() if k != "$defs"}
+    if isinstance(node, list):
+        return [_inline_refs(v, defs) for v in node]
+    return node
+
+def _response_schema() -> Dict[str, Any]:
+    schema = ParsedItem.model_json_schema()
+    return _inline_refs(schema, schema.get("$defs", {}))
+
+LLM_FORMAT: Any = _response_schema() if LLM_SCHEMA else "json"
+
+
 # ---------------- Санитайзинг & нормализация ----------------
 FORWARDED_RE = re.compile(r"^переслано от.*$", re.I | re.M)
-HASHTAG_RE = re.compile(r"(?:^|\s)#[\wА-Яа-я_]+")
+# хэштег после пробела; хэштег в самом начале текста снимается отдельно (HEAD_TAG_RE) —
+# без альтернативы с ^ регулярка сканирует текст в разы быстрее
+HASHTAG_RE = re.compile(r"\s#[\wА-Яа-я_]+")
+HEAD_TAG_RE = re.compile(r"#[\wА-Яа-я_]+")
 MULTISPACE_RE = re.compile(r"[ \t]{2,}")
 URL_RE = re.compile(r"https?://\S+")
+NL3_RE = re.compile(r"\n{3,}")
 
 PHONE_RE = re.compile(r"\+?\d[\d\s\-\.\(\)]{7,}")
 EMAIL_RE = re.compile(r"[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}")
 TG_RE = re.compile(r"@([A-Za-z0-9_]{4,})")
 
+# чистые функции от текста кэшируются: репосты/пересылки приходят с тем же текстом
+TEXT_CACHE_SIZE = 4096
+
+@lru_cache(maxsize=TEXT_CACHE_SIZE)
 def sanitize_text(t: str) -> str:
     if not t:
         return t
+    # проходы по порядку, как раньше (вырезанное порождает новые пробелы/пустые строки);
+    # проход пропускается, если в тексте нет того, что он ищет
     t = FORWARDED_RE.sub("", t)
-    t = HASHTAG_RE.sub("", t)
-    t = URL_RE.sub("", t)
-    t = MULTISPACE_RE.sub(" ", t)
-    t = re.sub(r"\n{3,}", "\n\n", t).strip()
-    return t
+    if "#" in t:
+        m = HEAD_TAG_RE.match(t)
+        if m:
+            t = t[m.end():]
+        t = HASHTAG_RE.sub("", t)
+    if "://" in t:
+        t = URL_RE.sub("", t)
+    if "  " in t or "\t" in t:
+        t = MULTISPACE_RE.sub(" ", t)
+    if "\n\n\n" in t:
+        t = NL3_RE.sub("\n\n", t)
+    return t.strip()
 
 CANON_EMPLOYMENT = {
     "полная занятость": "full_time",
@@ -196,6 +346,16 @@ CANON_EMPLOYMENT = {
     "temporary": "temporary",
 }
 
+# ключи CANON_EMPLOYMENT одной регуляркой (длинные первыми) — для фраз вида «полная занятость, вахта»
+EMPLOYMENT_RE = re.compile(r"\b(?:" + "|".join(re.escape(k) for k in sorted(CANON_EMPLOYMENT, key=len, reverse=True)) + r")\b")
+
+def _canon_employment(el: str) -> List[str]:
+    # el — уже в lower(); точное совпадение — словарём, иначе все ключи внутри фразы; ничего — как есть
+    hit = CANON_EMPLOYMENT.get(el)
+    if hit:
+        return [hit]
+    return [CANON_EMPLOYMENT[m.group(0)] for m in EMPLOYMENT_RE.finditer(el)] or [el]
+
 CANON_SCHEDULE = {
     "вахта": "вахта",
     "ротация": "вахта",
@@ -213,45 +373,51 @@ CANON_SCHEDULE = {
 
 CANON_EQUIP = ["GNSS", "GPS", "RTK", "Тахеометр", "Нивелир", "Дрон", "БПЛА", "Лазерный сканер", "ГИС", "QGIS", "Civil 3D", "Total Station"]
 CANON_SKILLS = ["AutoCAD", "Civil 3D", "Revit", "QGIS", "ArcGIS", "Topo", "CAD", "Python", "SQL", "Metashape", "Photogrammetry"]
+# точное совпадение без учёта регистра — словарём, до fuzzy
+_EQUIP_LC = {x.lower(): x for x in CANON_EQUIP}
+_SKILLS_LC = {x.lower(): x for x in CANON_SKILLS}
 
 CURRENCY_HINTS = {"₽": "RUB", "руб": "RUB", "т.р": "RUB", "тыс": "RUB", "KZT": "KZT", "₸": "KZT", "тенге": "KZT", "$": "USD", "USD": "USD", "дол": "USD", "€": "EUR", "EUR": "EUR"}
 SALARY_PERIOD_HINTS = {"/ч": "hour", "в час": "hour", "час": "hour", "/д": "day", "в день": "day", "смена": "shift", "в месяц": "month", "месяц": "month", "мес": "month", "м/ц": "month", "вахта": "rotation", "за проект": "project"}
 
-def _canon_list(values: List[str], universe: List[str], limit: int = 8) -> List[str]:
+def _hints_re(hints: Dict[str, str]) -> Tuple[re.Pattern, Dict[str, Tuple[int, str]]]:
+    # одна альтернатива на весь словарь (длинные ключи первыми) + ключ → (порядок в словаре, значение):
+    # из найденных выигрывает первый по словарю, а не самый левый в тексте
+    rank: Dict[str, Tuple[int, str]] = {}
+    for i, (k, v) in enumerate(hints.items()):
+        rank.setdefault(k.lower(), (i, v))
+    return re.compile("|".join(re.escape(k) for k in sorted(rank, key=len, reverse=True))), rank
+
+_CURR_RE, _CURR_RANK = _hints_re(CURRENCY_HINTS)
+_PERIOD_RE, _PERIOD_RANK = _hints_re(SALARY_PERIOD_HINTS)
+
+def _canon_list(values: List[str], universe: List[str], exact: Dict[str, str], limit: int = 8) -> List[str]:
+    vals = [v for v in ((v or "").strip() for v in (values or [])) if v][:limit]
+    if not vals:
+        return []
     out: List[str] = []
-    for v in (values or []):
-        v = (v or "").strip()
-        if not v:
+    for v in vals:
+        hit = exact.get(v.lower())
+        if hit:
+            out.append(hit)
             continue
-        res: Optional[Tuple[str, float, Any]] = process.extractOne(v, universe, scorer=fuzz.WRatio)
-        if res:
-            best, score, *_ = res
-            out.append(best if score >= 80 else v)
-        else:
-            out.append(v)
-        if len(out) >= limit:
-            break
-    seen = set(); uniq: List[str] = []
-    for x in out:
-        if x not in seen:
-            seen.add(x); uniq.append(x)
-    return uniq
+        # порог внутри rapidfuzz: кандидаты ниже 80 отсекаются, не досчитываясь
+        res: Optional[Tuple[str, float, Any]] = process.extractOne(v, universe, scorer=fuzz.WRatio, score_cutoff=80)
+        out.append(res[0] if res else v)
+    return list(dict.fromkeys(out))
 
 def normalize(parsed: ParsedItem) -> ParsedItem:
+    # канонизация и дедуп (с сохранением порядка) — одним проходом, без промежуточного списка
     if parsed.employment:
-        mapped = []
-        for e in parsed.employment:
-            el = (e or "").lower()
-            mapped.append(CANON_EMPLOYMENT.get(el, el))
-        parsed.employment = list(dict.fromkeys(mapped))
+        parsed.employment = list(dict.fromkeys(
+            c for e in parsed.employment for c in _canon_employment((e or "").lower())
+        ))
     if parsed.schedule:
-        mapped = []
-        for s in parsed.schedule:
-            sl = (s or "").lower()
-            mapped.append(CANON_SCHEDULE.get(sl, sl))
-        parsed.schedule = list(dict.fromkeys(mapped))
-    parsed.equipment = _canon_list(parsed.equipment, CANON_EQUIP)
-    parsed.skills = _canon_list(parsed.skills, CANON_SKILLS)
+        parsed.schedule = list(dict.fromkeys(
+            CANON_SCHEDULE.get(sl, sl) for sl in ((s or "").lower() for s in parsed.schedule)
+        ))
+    parsed.equipment = _canon_list(parsed.equipment, CANON_EQUIP, _EQUIP_LC)
+    parsed.skills = _canon_list(parsed.skills, CANON_SKILLS, _SKILLS_LC)
     if parsed.salary.currency not in {"RUB", "KZT", "USD", "EUR", "OTHER", "unknown"}:
         parsed.salary.currency = "OTHER"
     if parsed.salary.period not in {"month","day","hour","shift","rotation","project","unknown"}:
@@ -281,6 +447,11 @@ RE_CITY_ONLY = re.compile(r"(уренгой|белокаменка|москва|
 
 RE_EQUIP = re.compile(r"\b(гнсс|gnss|rtk|тахеометр|нивелир|бпла|дрон|сканер)\b", re.I)
 RE_SKILL = re.compile(r"\b(autocad|civil\s*3d|qgis|arcgis|metashape|камеральк(а|и))\b", re.I)
+RE_POSITION = re.compile(r"\b(инженер\s*пто|техник-?геодезист|геодезист(\s*камеральщик|\s*полевик)?|оператор\s*бпла|камеральщик)\b", re.I)
+RE_RATIO = re.compile(r"\b\d{1,2}\s*/\s*\d{1,2}\b")
+RE_RUB = re.compile(r"(₽|руб|т\.?р|тыс\.?)", re.I)
+RE_THOUSANDS = re.compile(r"(т\.?р|тыс\.?)", re.I)
+RE_NONDIGIT = re.compile(r"\D")
 
 def _period_from_text(t: str) -> str:
     if RE_PERIOD_MON.search(t): return "month"
@@ -291,13 +462,13 @@ def _period_from_text(t: str) -> str:
     return "unknown"
 
 def _rub_hint(t: str) -> str:
-    return "RUB" if re.search(r"(₽|руб|т\.?р|тыс\.?)", t, re.I) else "unknown"
+    return "RUB" if RE_RUB.search(t) else "unknown"
 
 def _intify(num_str: str, unit_hint: str) -> Optional[int]:
-    s = re.sub(r"\D", "", num_str or "")
+    s = RE_NONDIGIT.sub("", num_str or "")
     if not s: return None
     val = int(s)
-    if unit_hint and re.search(r"(т\.?р|тыс\.?)", unit_hint, re.I):
+    if unit_hint and RE_THOUSANDS.search(unit_hint):
         val *= 1000
     elif val < 1000:
         val *= 1000
@@ -308,73 +479,166 @@ def _intify(num_str: str, unit_hint: str) -> Optional[int]:
         return None
     return val
 
-def rule_enrich(parsed: ParsedItem, text: str) -> ParsedItem:
-    t = text
-    if parsed.role == "unknown":
-        if RE_TAG_VAC.search(t) or RE_NEED.search(t):
-            parsed.role = "employer"
-        elif RE_TAG_RESUME.search(t) or RE_OFFER_SELF.search(t):
-            parsed.role = "candidate"
-
-    if not parsed.position:
-        m = re.search(r"\b(инженер\s*пто|техник-?геодезист|геодезист(\s*камеральщик|\s*полевик)?|оператор\s*бпла|камеральщик)\b", t, re.I)
-        if m:
-            parsed.position = m.group(0).strip().title()
+# литералы, без которых регулярка заведомо не совпадёт (в тексте после casefold()):
+# один проход Aho-Corasick говорит, какие из регулярок _text_signals вообще запускать
+SIGNAL_ANCHORS: Dict[str, Tuple[str, ...]] = {
+    "vac": ("вакансия", "работа"),                                    # RE_TAG_VAC
+    "need": ("требуется", "ищем", "в компанию", "открыт набор"),     # RE_NEED
+    "resume": ("резюме", "камеральщик"),                              # RE_TAG_RESUME
+    "offer": ("предлагаю услуги", "готов", "ищу подработк", "ищу удаленк"),  # RE_OFFER_SELF
+    "position": ("инженер", "геодезист", "оператор", "камеральщик"),  # RE_POSITION
+    "salary": ("зп", "з/", "з:", "зарплата", "оплата"),               # RE_SALARY_TRUB
+    "rotation": ("вахт", "/"),                                        # RE_ROTATION
+    "loc": ("астраханск", "камчатка", "мурманск", "белокаменка", "уренгой", "москва", "московск", "шерегеш"),  # RE_LOC
+    "equip": ("гнсс", "gnss", "rtk", "тахеометр", "нивелир", "бпла", "дрон", "сканер"),  # RE_EQUIP
+    "skill": ("autocad", "civil", "qgis", "arcgis", "metashape", "камеральк"),            # RE_SKILL
+    "at": ("@",),                                                     # TG_RE, EMAIL_RE
+}
+ALL_SIGNALS = frozenset(SIGNAL_ANCHORS)
+
+if ahocorasick is not None:
+    _ANCHOR_KINDS: Dict[str, set] = {}
+    for _kind, _words in SIGNAL_ANCHORS.items():
+        for _w in _words:
+            _ANCHOR_KINDS.setdefault(_w, set()).add(_kind)
+    ANCHORS = ahocorasick.Automaton()
+    for _w, _kinds in _ANCHOR_KINDS.items():
+        ANCHORS.add_word(_w, frozenset(_kinds))
+    ANCHORS.make_automaton()
+
+def _present_signals(t: str) -> frozenset:
+    if ahocorasick is None:
+        return ALL_SIGNALS
+    tl = t.casefold()
+    # турецкие İ/ı: re.I сопоставляет их с i, а casefold() — нет
+    if "ı" in tl or "\u0307" in tl:
+        return ALL_SIGNALS
+    found: set = set()
+    for _, kinds in ANCHORS.iter(tl):
+        found |= kinds
+    return frozenset(found)
+
+@lru_cache(maxsize=TEXT_CACHE_SIZE)
+def _text_signals(t: str) -> Dict[str, Any]:
+    # всё, что rule_enrich достаёт из текста регулярками; от ParsedItem не зависит.
+    # результат общий для всех вызовов — списки отдаём кортежами
+    on = _present_signals(t)
+    role = None
+    if ("vac" in on and RE_TAG_VAC.search(t)) or ("need" in on and RE_NEED.search(t)):
+        role = "employer"
+    elif ("resume" in on and RE_TAG_RESUME.search(t)) or ("offer" in on and RE_OFFER_SELF.search(t)):
+        role = "candidate"
+
+    m = RE_POSITION.search(t) if "position" in on else None
+    position = m.group(0).strip().title() if m else None
+
+    # телефоны — одним проходом: и для отсева «зарплат»-номеров, и для контакта.
+    # спаны finditer не пересекаются, так что и начала, и концы отсортированы
+    phones = [ph.span() for ph in PHONE_RE.finditer(t)]
+    phone_ends = [e for _, e in phones]
+
+    salary = None
+    m = ("salary" in on and RE_SALARY_TRUB.search(t)) or RE_SALARY_NUM.search(t)
+    if m:
+        a, b = m.span()
+        # первый телефон, кончающийся правее a, пересекается с [a, b), если начинается левее b
+        i = bisect.bisect_right(phone_ends, a)
+        phone_hit = i < len(phones) and phones[i][0] < b
+        if not phone_hit:
+            base = m.group(2) if (m.lastindex and m.lastindex >= 2 and m.group(2)) else (m.group(1) if m.lastindex and m.group(1) else m.group(0))
+            unit = m.group(4) if (m.lastindex and m.lastindex >= 4) else ""
+            val = _intify(base, unit or "")
+            if val is not None:
+                salary = (val, _rub_hint(t), _period_from_text(t))
+
+    # один проход RE_ROTATION: любое совпадение — вахта, вторая группа — соотношения 15/15
+    # (та же регулярка, что RE_RATIO, и с «вахта» не пересекается)
+    rot = [m.group(2) for m in RE_ROTATION.finditer(t)] if "rotation" in on else []
+    rotation = bool(rot)
+    ratios = tuple(r for r in rot if r)
+
+    city = region = None
+    if "loc" in on:
+        # RE_CITY_ONLY — по разу на найденное место; первый город важнее региона
+        locs = [m.group(0) for m in RE_LOC.finditer(t)]
+        city_loc = next((x for x in locs if RE_CITY_ONLY.search(x)), None)
+        if city_loc:
+            city = city_loc.title()
+        elif locs:
+            region = locs[0].title()
+
+    tg = TG_RE.search(t) if "at" in on else None
+    em = EMAIL_RE.search(t) if "at" in on else None
+    return {
+        "role": role,
+        "position": position,
+        "salary": salary,
+        "rotation": rotation,
+        "ratios": ratios,
+        "city": city,
+        "region": region,
+        "equipment": tuple({m.group(0).upper() for m in RE_EQUIP.finditer(t)}) if "equip" in on else (),
+        "skills": tuple(m.group(0).upper() for m in RE_SKILL.finditer(t)) if "skill" in on else (),
+        "phone": t[phones[0][0]:phones[0][1]] if phones else None,
+        "telegram": f"@{tg.group(1)}" if tg else None,
+        "email": em.group(0) if em else None,
+    }
 
-    if parsed.salary.min is None and parsed.salary.max is None:
-        m = RE_SALARY_TRUB.search(t) or RE_SALARY_NUM.search(t)
-        if m:
-            span = m.span()
-            phone_hit = any(not (ph.end() <= span[0] or ph.start() >= span[1]) for ph in PHONE_RE.finditer(t))
-            if not phone_hit:
-                base = m.group(2) if (m.lastindex and m.lastindex >= 2 and m.group(2)) else (m.group(1) if m.lastindex and m.group(1) else m.group(0))
-                unit = m.group(4) if (m.lastindex and m.lastindex >= 4) else ""
-                val = _intify(base, unit or "")
-                if val is not None:
-                    parsed.salary.min = val
-                    parsed.salary.max = None
-                    if parsed.salary.currency == "unknown":
-                        parsed.salary.currency = _rub_hint(t)
-                    if parsed.salary.period == "unknown":
-                        parsed.salary.period = _period_from_text(t)
-
-    if RE_ROTATION.search(t):
+def rule_enrich(parsed: ParsedItem, text: str) -> ParsedItem:
+    sig = _text_signals(text)
+    if parsed.role == "unknown" and sig["role"]:
+        parsed.role = sig["role"]
+
+    if not parsed.position and sig["position"]:
+        parsed.position = sig["position"]
+
+    if parsed.salary.min is None and parsed.salary.max is None and sig["salary"]:
+        val, currency, period = sig["salary"]
+        parsed.salary.min = val
+        parsed.salary.max = None
+        if parsed.salary.currency == "unknown":
+            parsed.salary.currency = currency
+        if parsed.salary.period == "unknown":
+            parsed.salary.period = period
+
+    if sig["rotation"]:
         if "rotation" not in parsed.employment:
             parsed.employment.append("rotation")
         if "вахта" not in parsed.schedule:
             parsed.schedule.append("вахта")
-        for ratio in re.findall(r"\b\d{1,2}\s*/\s*\d{1,2}\b", t):
+        for ratio in sig["ratios"]:
             if ratio not in parsed.schedule:
                 parsed.schedule.append(ratio)
 
-    if not (parsed.city.city or parsed.city.region):
-        locs = [m.group(0) for m in RE_LOC.finditer(t)]
-        if locs:
-            if any(RE_CITY_ONLY.search(x) for x in locs):
-                parsed.city.city = next(x for x in locs if RE_CITY_ONLY.search(x)).title()
-            else:
-                parsed.city.region = locs[0].title()
-            if not parsed.city.country:
-                parsed.city.country = "Россия"
+    if not (parsed.city.city or parsed.city.region) and (sig["city"] or sig["region"]):
+        if sig["city"]:
+            parsed.city.city = sig["city"]
+        else:
+            parsed.city.region = sig["region"]
+        if not parsed.city.country:
+            parsed.city.country = "Россия"
 
-    if RE_EQUIP.search(t) and not parsed.equipment:
-        parsed.equipment = list({m.group(0).upper() for m in RE_EQUIP.finditer(t)})
-    if RE_SKILL.search(t) and not parsed.skills:
-        parsed.skills = [m.group(0).upper() for m in RE_SKILL.finditer(t)]
+    if sig["equipment"] and not parsed.equipment:
+        parsed.equipment = list(sig["equipment"])
+    if sig["skills"] and not parsed.skills:
+        parsed.skills = list(sig["skills"])
 
     if not (parsed.contact.phone or parsed.contact.telegram or parsed.contact.email):
-        ph = PHONE_RE.search(t); tg = TG_RE.search(t); em = EMAIL_RE.search(t)
-        if ph: parsed.contact.phone = ph.group(0)
-        if tg: parsed.contact.telegram = f"@{tg.group(1)}"
-        if em: parsed.contact.email = em.group(0)
+        if sig["phone"]: parsed.contact.phone = sig["phone"]
+        if sig["telegram"]: parsed.contact.telegram = sig["telegram"]
+        if sig["email"]: parsed.contact.email = sig["email"]
 
     return normalize(parsed)
 
 # ---------------- Подсказки и очистка ----------------
+@lru_cache(maxsize=TEXT_CACHE_SIZE)
+def _hints(t: str) -> Tuple[str, str]:
+    currency = min((_CURR_RANK[m.group(0)] for m in _CURR_RE.finditer(t)), default=(0, "unknown"))[1]
+    period = min((_PERIOD_RANK[m.group(0)] for m in _PERIOD_RE.finditer(t)), default=(0, "unknown"))[1]
+    return currency, period
+
 def cheap_hints(text: str) -> Dict[str, str]:
-    t = text.lower()
-    currency = next((v for k, v in CURRENCY_HINTS.items() if k in t), "unknown")
-    period = next((v for k, v in SALARY_PERIOD_HINTS.items() if k in t), "unknown")
+    currency, period = _hints(text.lower())
     return {"currency": currency, "period": period}
 
 def clean_num(x, as_int=False):
@@ -396,20 +660,47 @@ def clean_str(s, maxlen=40000):
     return s[:maxlen] if len(s) > maxlen else s
 
 # ---------------- DB I/O ----------------
-@retry(wait=wait_exponential_jitter(initial=1, max=8), stop=stop_after_attempt(5))
-def fetch_batch(limit: int) -> List[Dict[str, Any]]:
-    res = (
-        sb.table(RAW_TABLE)
-        .select("*")
-        .order("published_at", desc=False)
-        .order("fetched_at", desc=False)
-        .limit(limit)
-        .execute()
-    )
-    return list(res.data or [])
+_PG: Optional["AsyncConnectionPool"] = None
+
+async def _pg() -> "AsyncConnectionPool":
+    # один пул на процесс; открывается при первом обращении
+    global _PG
+    if _PG is None:
+        _PG = AsyncConnectionPool(
+            DATABASE_URL, min_size=1, max_size=PG_POOL_MAX, max_idle=300,
+            kwargs={"prepare_threshold": PREPARE_THRESHOLD},
+            open=False,
+        )
+        await _PG.open()
+    return _PG
 
-@retry(wait=wait_exponential_jitter(initial=1, max=6), stop=stop_after_attempt(5))
-def upsert_job(raw_row: Dict[str, Any], parsed: ParsedItem):
+async def close_pg() -> None:
+    global _PG
+    if _PG is not None:
+        await _PG.close()
+        _PG = None
+
+@retry(wait=wait_exponential_jitter(initial=1, max=8), stop=stop_after_attempt(5))
+async def fetch_batch(limit: int, exclude: Sequence[Any] = ()) -> List[Dict[str, Any]]:
+    # exclude — raw_id строк, которые ещё в работе (их результат пока не записан)
+    exclude = [x for x in exclude if x is not None]
+    if DATABASE_URL:
+        # to_jsonb — строки в том же виде, что отдаёт PostgREST (даты строками ISO), dedup_hash не меняется
+        cols = sql.SQL("*") if RAW_COLUMNS == ["*"] else sql.SQL(", ").join(map(sql.Identifier, dict.fromkeys(RAW_COLUMNS)))
+        q = sql.SQL(
+            "select to_jsonb(r) from (select {} from {} {} order by published_at, fetched_at limit %s) r"
+        ).format(cols, sql.Identifier(RAW_TABLE), sql.SQL("where raw_id <> all(%s)" if exclude else ""))
+        async with (await _pg()).connection() as conn:
+            cur = await conn.execute(q, (exclude, limit) if exclude else (limit,))
+            return [r[0] for r in await cur.fetchall()]
+    params: Dict[str, Any] = {"select": ",".join(dict.fromkeys(RAW_COLUMNS)), "order": "published_at.asc,fetched_at.asc", "limit": limit}
+    if exclude:
+        params["raw_id"] = f"not.in.({','.join(map(str, exclude))})"
+    r = await _rest().get(f"/{RAW_TABLE}", params=params)
+    _rest_check(r)
+    return list(json_loads(r.content) or [])
+
+def build_record(raw_row: Dict[str, Any], parsed: ParsedItem) -> Dict[str, Any]:
     def join_or_none(lst: Optional[List[str]]):
         if not lst: return None
         s = ", ".join(x for x in lst if x)
@@ -447,18 +738,80 @@ def upsert_job(raw_row: Dict[str, Any], parsed: ParsedItem):
         "posted_at": posted_at,
     }
 
-    import hashlib
     src = f"{rec.get('description') or ''}|{raw_row.get('author') or ''}|{rec.get('posted_at') or ''}"
     rec["dedup_hash"] = hashlib.sha1(src.encode("utf-8", "ignore")).hexdigest()
+    return rec
+
+def _upsert_sql(cols: List[str]):
+    # как upsert PostgREST с on_conflict: при конфликте перезаписываются все переданные колонки
+    return sql.SQL("insert into {} ({}) values ({}) on conflict (raw_item_id) do update set {}").format(
+        sql.Identifier(PARSED_TABLE),
+        sql.SQL(", ").join(map(sql.Identifier, cols)),
+        sql.SQL(", ").join(sql.Placeholder() * len(cols)),
+        sql.SQL(", ").join(sql.SQL("{0} = excluded.{0}").format(sql.Identifier(c)) for c in cols if c != "raw_item_id"),
+    )
+
+# upsert по raw_item_id; тело ответа не нужно
+UPSERT_HEADERS = {**JSON_HEADERS, "Prefer": "resolution=merge-duplicates,return=minimal"}
+
+async def _post_upsert(payload: Any) -> None:
+    r = await _rest().post(
+        f"/{PARSED_TABLE}", params={"on_conflict": "raw_item_id"},
+        content=json_dumps(payload), headers=UPSERT_HEADERS,
+    )
+    _rest_check(r)
 
+@retry(wait=wait_exponential_jitter(initial=1, max=6), stop=stop_after_attempt(5))
+async def upsert_job(rec: Dict[str, Any]):
+    await _post_upsert(rec)
+
+# ретраим только сбои соединения: ошибка данных (переполнение, constraint) от повтора не пройдёт
+@retry(
+    retry=retry_if_exception_type(PgOperationalError),
+    wait=wait_exponential_jitter(initial=1, max=6),
+    stop=stop_after_attempt(5),
+    reraise=True,
+)
+async def upsert_jobs_pg(records: List[Dict[str, Any]]) -> None:
+    # весь батч — одним executemany в одной транзакции
+    cols = list(records[0])
+    async with (await _pg()).connection() as conn:
+        async with conn.cursor() as cur:
+            await cur.executemany(_upsert_sql(cols), [tuple(r[c] for c in cols) for r in records])
+
+async def _upsert_rows_pg(records: List[Dict[str, Any]]) -> None:
+    # каждая строка — своей транзакцией: «плохая» откатывается одна, остальные записываются
+    cols = list(records[0])
+    q = _upsert_sql(cols)
+    async with (await _pg()).connection() as conn:
+        for rec in records:
+            try:
+                async with conn.transaction():
+                    await conn.execute(q, tuple(rec[c] for c in cols))
+            except Exception as e:
+                pretty_print(f"[red]Ошибка записи raw_item_id={rec.get('raw_item_id')}:[/] {e!r}")
+
+async def upsert_jobs_rest(records: List[Dict[str, Any]]) -> None:
+    # PostgREST принимает массив: весь батч — одним POST
+    await _post_upsert(records)
+
+async def _upsert_rows_rest(records: List[Dict[str, Any]]) -> None:
+    for rec in records:
+        try:
+            await upsert_job(rec)
+        except Exception as e:
+            pretty_print(f"[red]Ошибка записи raw_item_id={rec.get('raw_item_id')}:[/] {e!r}")
+
+async def upsert_jobs(records: List[Dict[str, Any]]) -> None:
+    if not records:
+        return
+    bulk, per_row = (upsert_jobs_pg, _upsert_rows_pg) if DATABASE_URL else (upsert_jobs_rest, _upsert_rows_rest)
     try:
-        sb.table(PARSED_TABLE).upsert(rec, on_conflict="raw_item_id").execute()
-    except PostgrestAPIError as e:
-        pretty_print(
-            f"[red]Supabase APIError[/] code={getattr(e,'code',None)} "
-            f"msg={getattr(e,'message',None)} hint={getattr(e,'hint',None)} details={getattr(e,'details',None)}"
-        )
-        raise
+        await bulk(records)
+    except Exception as e:
+        # одна «плохая» строка валит весь батч — тогда по одной, как раньше
+        pretty_print(f"[yellow]Батч-upsert не прошёл ({e!r}) — пишу по одной[/]")
+        await per_row(records)
 
 # ---------------- LLM (Ollama Cloud → Local) ----------------
 SYSTEM_PROMPT = (
@@ -483,42 +836,133 @@ EXTRACTION_INSTRUCTION = (
     "— Если данных нет — ставь null или пустой список.\n"
     "— Отвечай ЧИСТЫМ JSON без лишних символов."
 )
+# неизменная часть запроса — собрана один раз; на строку остаётся одна конкатенация
+EXTRACTION_PREFIX = EXTRACTION_INSTRUCTION + "\nТекст:\n"
+SYSTEM_MESSAGE = {"role": "system", "content": SYSTEM_PROMPT}
+
+# один AsyncClient на процесс: keep-alive и TLS переиспользуются между запросами к Ollama
+_HTTP: Optional[httpx.AsyncClient] = None
+
+def _http() -> httpx.AsyncClient:
+    global _HTTP
+    if _HTTP is None or _HTTP.is_closed:
+        # connect короткий: недоступный хост должен быстро уводить в фолбэк, а не висеть минуту;
+        # простаивающие keep-alive соединения закрываем сами, раньше чем их оборвёт сервер/прокси
+        _HTTP = httpx.AsyncClient(
+            timeout=httpx.Timeout(connect=5.0, read=LLM_READ_TIMEOUT, write=10.0, pool=60.0),
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=30.0),
+            # h2 согласуется только по TLS (ALPN); локальный http://-Ollama остаётся на HTTP/1.1 keep-alive
+            http2=HAS_H2,
+        )
+    return _HTTP
+
+async def close_http() -> None:
+    global _HTTP
+    if _HTTP is not None:
+        await _HTTP.aclose()
+        _HTTP = None
 
 LIMIT_HTTP_STATUSES = {401, 402, 403, 429}
 LIMIT_TEXT_PATTERNS = ("limit","quota","credit","payment","billing","insufficient","not permitted","not allowed","subscription","rate limit")
 
-async def _ollama_chat(host: str, model: str, text: str, api_key: Optional[str] = None, *, parse_json: bool = True) -> Dict[str, Any]:
-    payload = {
+# после закрытия JSON модель с format=json иногда тянет одни пробелы до num_predict:
+# столько пустых кусочков подряд — и стрим бросаем, не дожидаясь done
+TRAILING_WS_CHUNKS = 8
+
+async def _ollama_stream(host: str, body: bytes, headers: Dict[str, str], parse_json: bool) -> Any:
+    # stream: ответ идёт по кусочкам (ndjson), так что read-таймаут считается между кусочками,
+    # а не на всю генерацию, и готовый JSON виден, как только закрылась последняя скобка.
+    # вернёт готовый dict (ранний выход) или весь текст ответа
+    parts: List[str] = []
+    async with _http().stream("POST", f"{host}/api/chat", content=body, headers=headers) as r:
+        if r.is_error:
+            await r.aread()  # тело нужно вызывающему (e.response.text) для разбора лимитов
+        r.raise_for_status()
+        if not parse_json:
+            return {"ok": True}
+        done_obj: Optional[Dict[str, Any]] = None
+        idle = 0
+        async for line in r.aiter_lines():
+            if not line.strip():
+                continue
+            chunk = json_loads(line)
+            if chunk.get("error"):
+                raise RuntimeError(f"Ошибка LLM: {chunk['error']}")
+            piece = (chunk.get("message") or {}).get("content") or chunk.get("response") or ""
+            parts.append(piece)
+            if done_obj is not None:
+                if piece.strip():
+                    done_obj = None  # после JSON пошёл текст — разбираем целиком, как раньше
+                else:
+                    idle += 1
+                    if idle >= TRAILING_WS_CHUNKS:
+                        return done_obj
+            elif piece.rstrip().endswith("}"):
+                try:
+                    done_obj = json_loads("".join(parts))
+                    idle = 0
+                except json.JSONDecodeError:
+                    pass
+            if chunk.get("done"):
+                break
+        if done_obj is not None:
+            return done_obj
+    return "".join(parts)
+
+@lru_cache(maxsize=None)
+def _chat_envelope(model: str) -> Tuple[bytes, bytes]:
+    # тело запроса без текста строки, сериализованное один раз на модель (схема format и промпт — килобайты):
+    # ...,"content":"  +  текст как JSON-строка без кавычек  +  "}]}
+    body = json_dumps({
         "model": model,
-        "format": "json",
-        "stream": False,
-        "options": {"num_ctx": 8192, "temperature": 0},
-        "messages": [
-            {"role": "system", "content": SYSTEM_PROMPT},
-            {"role": "user", "content": EXTRACTION_INSTRUCTION + "\nТекст:\n" + text},
-        ],
-    }
-    headers = {}
+        "format": LLM_FORMAT,
+        "stream": LLM_STREAM,
+        "keep_alive": LLM_KEEP_ALIVE,
+        "options": LLM_OPTIONS,
+        "messages": [SYSTEM_MESSAGE, {"role": "user", "content": ""}],
+    })
+    if not body.endswith(b'""}]}'):
+        # без этого склейка ниже молча слала бы битый JSON
+        raise RuntimeError(f"Неожиданный конец тела запроса к Ollama: {body[-16:]!r}")
+    return body[:-4], body[-4:]
+
+async def _ollama_chat(host: str, model: str, text: str, api_key: Optional[str] = None, *, parse_json: bool = True) -> Dict[str, Any]:
+    head, tail = _chat_envelope(model)
+    body = head + json_dumps(EXTRACTION_PREFIX + text)[1:-1] + tail
+    headers = dict(JSON_HEADERS)
     if host.startswith("https://ollama.com") and api_key:
         headers["Authorization"] = api_key  # если нужен Bearer, поменяй здесь
-    async with httpx.AsyncClient(timeout=60) as client:
-        r = await client.post(f"{host}/api/chat", json=payload, headers=headers)
+    if LLM_STREAM:
+        res = await _ollama_stream(host, body, headers, parse_json)
+        if isinstance(res, dict):
+            return res
+        content = res
+    else:
+        r = await _http().post(f"{host}/api/chat", content=body, headers=headers)
         r.raise_for_status()
         if not parse_json:
             return {"ok": True}
-        data = r.json()
-        content = data.get("message", {}).get("content") or data.get("response")
-        if not content:
-            raise RuntimeError("Пустой ответ от LLM")
-        try:
-            return json.loads(content)
-        except json.JSONDecodeError:
-            m = re.search(r"\{[\s\S]*\}", content)
-            if not m:
-                raise
-            return json.loads(m.group(0))
+        data = json_loads(r.content)
+        if data.get("error"):
+            raise RuntimeError(f"Ошибка LLM: {data['error']}")
+        content = (data.get("message") or {}).get("content") or data.get("response") or ""
+    if not content:
+        raise RuntimeError("Пустой ответ от LLM")
+    try:
+        return json_loads(content)
+    except json.JSONDecodeError:
+        m = JSON_OBJ_RE.search(content)
+        if not m:
+            raise
+        return json_loads(m.group(0))
 
 FALLBACK_ACTIVATED = False
+FALLBACK_AT = 0.0     # когда переключились на локальную (time.monotonic())
+
+def _activate_fallback() -> None:
+    global FALLBACK_ACTIVATED, FALLBACK_AT
+    FALLBACK_ACTIVATED = True
+    FALLBACK_AT = time.monotonic()
 
 async def cloud_preflight() -> bool:
     if not CLOUD_MODEL:
@@ -535,9 +979,36 @@ async def cloud_preflight() -> bool:
     except Exception:
         return False
 
+async def prewarm_models() -> None:
+    # generate без prompt: Ollama загружает модель и держит её keep_alive, а в пуле остаётся
+    # готовое соединение — первый батч не ждёт загрузки. облачные модели не греем
+    targets = set()
+    if not CLOUD_MODEL or FALLBACK_ACTIVATED:
+        targets.update((h, LOCAL_MODEL) for h in LOCAL_HOSTS)
+    if ENABLE_VALIDATOR and VALIDATOR_MODEL and not VALIDATOR_HOST.startswith("https://ollama.com"):
+        targets.add((VALIDATOR_HOST, VALIDATOR_MODEL))
+
+    async def warm(host: str, model: str) -> None:
+        t0 = time.monotonic()
+        try:
+            r = await _http().post(
+                f"{host}/api/generate", content=json_dumps({"model": model, "keep_alive": LLM_KEEP_ALIVE}),
+                headers=JSON_HEADERS, timeout=httpx.Timeout(300.0, connect=5.0),
+            )
+            r.raise_for_status()
+            pretty_print(f"[dim]Прогрета {model} @ {host} за {time.monotonic() - t0:.1f} с[/]")
+        except Exception as e:
+            pretty_print(f"[yellow]Не удалось прогреть {model} @ {host}: {e!r}[/]")
+
+    await asyncio.gather(*(warm(h, m) for h, m in targets))
+
 async def call_llm_with_failover(text: str) -> Dict[str, Any]:
     global FALLBACK_ACTIVATED
 
+    # лимиты облака обычно временные: спустя CLOUD_RETRY_SECONDS пробуем его снова
+    if FALLBACK_ACTIVATED and CLOUD_RETRY_SECONDS and time.monotonic() - FALLBACK_AT >= CLOUD_RETRY_SECONDS:
+        FALLBACK_ACTIVATED = False
+
     # 1) облако (если доступно и не отключено)
     if CLOUD_MODEL and not FALLBACK_ACTIVATED:
         try:
@@ -548,17 +1019,63 @@ async def call_llm_with_failover(text: str) -> Dict[str, Any]:
             body = (e.response.text or "").lower()
             if (status in LIMIT_HTTP_STATUSES) or any(p in body for p in LIMIT_TEXT_PATTERNS):
                 pretty_print("[yellow]Cloud лимит/нет доступа — переключаюсь на локальную модель[/]")
-                FALLBACK_ACTIVATED = True
+                _activate_fallback()
             else:
                 pretty_print(f"[yellow]Cloud ошибка {status} — переключаюсь на локальную[/]")
-                FALLBACK_ACTIVATED = True
+                _activate_fallback()
         except Exception as e:
             pretty_print(f"[yellow]Cloud недоступен ({e!r}) — локальный фолбэк[/]")
-            FALLBACK_ACTIVATED = True
+            _activate_fallback()
 
     # 2) локальный фолбэк
     pretty_print(f"[dim]→ Local {LOCAL_MODEL}[/dim]")
-    return await _ollama_chat(LOCAL_HOST, LOCAL_MODEL, text)
+    return await _local_chat(text)
+
+# локальный вызов при сбое соединения — до 3 попыток. ReadTimeout не ретраим: медленная генерация
+# повторилась бы целиком и съела бы потолок LLM_READ_TIMEOUT. облако не ретраим вовсе —
+# его сбои разбирает call_llm_with_failover и быстро уходит в фолбэк
+_ollama_chat_retrying = retry(
+    retry=retry_if_exception_type((httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError)),
+    wait=wait_exponential_jitter(initial=1, max=8),
+    stop=stop_after_attempt(3),
+    reraise=True,
+)(_ollama_chat)
+
+# запросов в работе по каждому локальному хосту и до какого момента (time.monotonic()) хост считается лежащим
+_HOST_INFLIGHT: Dict[str, int] = {}
+_HOST_DOWN_UNTIL: Dict[str, float] = {}
+
+def _host_failed(e: Exception) -> bool:
+    # сбой самого хоста, а не этого запроса (4xx — про запрос, на другом хосте будет то же)
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code >= 500
+    return isinstance(e, httpx.TransportError)
+
+async def _local_chat(text: str) -> Dict[str, Any]:
+    if len(LOCAL_HOSTS) == 1:
+        return await _ollama_chat_retrying(LOCAL_HOSTS[0], LOCAL_MODEL, text)
+    # наименее загруженный из живых хостов (при равенстве — первый по списку); не ответил — следующий.
+    # лежащий хост иначе «освобождался» бы быстрее всех и собирал бы больше строк
+    tried: set = set()
+    while True:
+        now = time.monotonic()
+        left = [h for h in LOCAL_HOSTS if h not in tried]
+        up = [h for h in left if _HOST_DOWN_UNTIL.get(h, 0.0) <= now] or left  # лежат все — пробуем всё равно
+        host = min(up, key=lambda h: _HOST_INFLIGHT.get(h, 0))
+        tried.add(host)
+        _HOST_INFLIGHT[host] = _HOST_INFLIGHT.get(host, 0) + 1
+        try:
+            return await _ollama_chat(host, LOCAL_MODEL, text)
+        except Exception as e:
+            if not _host_failed(e):
+                raise
+            _HOST_DOWN_UNTIL[host] = time.monotonic() + HOST_COOLDOWN_SECONDS
+            # ReadTimeout: генерацию на другом хосте заново не начинаем — это снова полный таймаут
+            if isinstance(e, httpx.ReadTimeout) or len(tried) == len(LOCAL_HOSTS):
+                raise
+            pretty_print(f"[yellow]Ollama {host} не ответил ({e!r}) — выключен на {HOST_COOLDOWN_SECONDS:.0f} с, пробую другой хост[/]")
+        finally:
+            _HOST_INFLIGHT[host] -= 1
 
 # --------- THINKING VALIDATOR (опционально) ----------
 VALIDATOR_SYSTEM = (
@@ -602,7 +1119,7 @@ def rule_impute_geo(p: ParsedItem) -> ParsedItem:
     return p
 
 def rule_impute_schedule(p: ParsedItem, text: str) -> ParsedItem:
-    if re.search(r"\b\d{1,2}\s*/\s*\d{1,2}\b", text):
+    if RE_RATIO.search(text):
         if "вахта" not in (p.schedule or []):
             p.schedule.append("вахта")
         if "rotation" not in (p.employment or []):
@@ -618,43 +1135,65 @@ def rule_fix_salary(p: ParsedItem, text: str) -> ParsedItem:
         p.salary.min, p.salary.max = p.salary.max, p.salary.min
     return p
 
+# кэш доступности валидатора: проба — не чаще раза в VALIDATOR_RECHECK_SECONDS, а не на каждой строке;
+# успешный вызов продлевает «жив», сетевой/HTTP-сбой выключает на тот же срок
+_VALIDATOR_STATE: Dict[str, Any] = {"ok": None, "checked_at": 0.0}
+_VALIDATOR_LOCK = asyncio.Lock()
+
+def _mark_validator(ok: bool) -> None:
+    _VALIDATOR_STATE["ok"] = ok
+    _VALIDATOR_STATE["checked_at"] = time.monotonic()
+
+def _validator_fresh() -> bool:
+    return _VALIDATOR_STATE["ok"] is not None and time.monotonic() - _VALIDATOR_STATE["checked_at"] < VALIDATOR_RECHECK_SECONDS
+
 async def _validator_available() -> bool:
     if not ENABLE_VALIDATOR or not VALIDATOR_MODEL:
         return False
+    if _validator_fresh():
+        return _VALIDATOR_STATE["ok"]
+    # проверяет одна корутина; остальные строки батча ждут её результат
+    async with _VALIDATOR_LOCK:
+        if not _validator_fresh():
+            _mark_validator(await _probe_validator())
+    return _VALIDATOR_STATE["ok"]
+
+async def _probe_validator() -> bool:
     # быстрый префлайт
     try:
-        payload = {"model": VALIDATOR_MODEL, "format": "json", "stream": False, "messages": [{"role": "user", "content": '{"probe":true}'}]}
-        headers = {}
+        payload = {"model": VALIDATOR_MODEL, "format": "json", "stream": False, "keep_alive": LLM_KEEP_ALIVE, "messages": [{"role": "user", "content": '{"probe":true}'}]}
+        headers = dict(JSON_HEADERS)
         if VALIDATOR_HOST.startswith("https://ollama.com") and CLOUD_API_KEY:
             headers["Authorization"] = CLOUD_API_KEY
-        async with httpx.AsyncClient(timeout=5) as client:
-            r = await client.post(f"{VALIDATOR_HOST}/api/chat", json=payload, headers=headers)
-            r.raise_for_status()
-            return True
+        r = await _http().post(f"{VALIDATOR_HOST}/api/chat", content=json_dumps(payload), headers=headers, timeout=5)
+        r.raise_for_status()
+        return True
     except Exception:
         return False
 
 async def call_validator_llm_async(parsed: ParsedItem, text: str) -> ParsedItem:
     body = {
         "model": VALIDATOR_MODEL,
-        "format": "json",
+        "format": LLM_FORMAT,
         "stream": False,
-        "options": {"num_ctx": 8192, "temperature": 0},
+        "keep_alive": LLM_KEEP_ALIVE,
+        "options": LLM_OPTIONS,
         "messages": [
             {"role": "system", "content": VALIDATOR_SYSTEM},
             {"role": "user", "content": VALIDATOR_USER_TMPL.format(TEXT=text, JSON=parsed.model_dump_json())},
         ],
     }
-    headers = {}
+    headers = dict(JSON_HEADERS)
     if VALIDATOR_HOST.startswith("https://ollama.com") and CLOUD_API_KEY:
         headers["Authorization"] = CLOUD_API_KEY
-    async with httpx.AsyncClient(timeout=60) as client:
-        r = await client.post(f"{VALIDATOR_HOST}/api/chat", json=body, headers=headers)
-        r.raise_for_status()
-        data = r.json()
-        content = data.get("message", {}).get("content") or data.get("response")
-        obj = json.loads(re.search(r"\{[\s\S]*\}", content).group(0)) if isinstance(content, str) else content
-        return ParsedItem.model_validate(obj)
+    r = await _http().post(f"{VALIDATOR_HOST}/api/chat", content=json_dumps(body), headers=headers)
+    r.raise_for_status()
+    data = json_loads(r.content)
+    content = data.get("message", {}).get("content") or data.get("response")
+    if isinstance(content, str):
+        # разбор и валидация — одним проходом pydantic-core, без промежуточного dict
+        return ParsedItem.model_validate_json(JSON_OBJ_RE.search(content).group(0))
+    return ParsedItem.model_validate(content)
 
 async def validate_and_impute(parsed: ParsedItem, text: str) -> ParsedItem:
     p = rule_impute_geo(parsed)
@@ -663,28 +1202,56 @@ async def validate_and_impute(parsed: ParsedItem, text: str) -> ParsedItem:
     if await _validator_available():
         try:
             p2 = await call_validator_llm_async(p, text)
+            _mark_validator(True)
             p2 = normalize(p2)
             return p2
         except Exception as e:
-            pretty_print(f"[yellow]Validator пропущен: {e!r}[/]")
+            # выключаем только при сбое самого валидатора (соединение, 5xx); 4xx — про эту строку
+            if not _host_failed(e):
+                pretty_print(f"[yellow]Validator пропущен: {e!r}[/]")
+                return p
+            _mark_validator(False)
+            pretty_print(f"[yellow]Validator недоступен, выключен на {VALIDATOR_RECHECK_SECONDS:.0f} с: {e!r}[/]")
             return p
     return p
 
 # ---------------- Pipeline ----------------
-async def parse_one(row: Dict[str, Any]) -> None:
+_LLM_SEM = asyncio.Semaphore(LLM_CONCURRENCY)
+
+# sha1 текста запроса → JSON ответа LLM (только удачные ответы)
+_LLM_CACHE: "OrderedDict[bytes, Dict[str, Any]]" = OrderedDict()
+
+async def call_llm_cached(text: str) -> Dict[str, Any]:
+    key = hashlib.sha1(text.encode("utf-8")).digest()
+    hit = _LLM_CACHE.get(key)
+    if hit is not None:
+        _LLM_CACHE.move_to_end(key)
+        return hit
+    res = await call_llm_with_failover(text)
+    if LLM_CACHE_SIZE > 0:
+        _LLM_CACHE[key] = res
+        if len(_LLM_CACHE) > LLM_CACHE_SIZE:
+            _LLM_CACHE.popitem(last=False)
+    return res
+
+async def parse_one(row: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+    async with _LLM_SEM:
+        return await _parse_one(row)
+
+async def _parse_one(row: Dict[str, Any]) -> Optional[Dict[str, Any]]:
     raw_text = (row.get(RAW_TEXT_FIELD) or "").strip()
     text = sanitize_text(raw_text)
     if not text:
-        return
+        return None
     hints = cheap_hints(text)
     hinted_text = f"{text}\n\n[meta hints] currency≈{hints['currency']}, period≈{hints['period']}"
     try:
-        llm_json = await call_llm_with_failover(hinted_text)
+        llm_json = await call_llm_cached(hinted_text)
         parsed = ParsedItem.model_validate(llm_json)
     except Exception as e:
         try:
-            m = re.search(r"\{[\s\S]*\}", str(e))
-            llm_json = json.loads(m.group(0)) if m else {}
+            m = JSON_OBJ_RE.search(str(e))
+            llm_json = json_loads(m.group(0)) if m else {}
         except Exception:
             llm_json = {}
         stub = {
@@ -717,75 +1284,96 @@ async def parse_one(row: Dict[str, Any]) -> None:
         if email: parsed.contact.email = email.group(0)
         if tg: parsed.contact.telegram = f"@{tg.group(1)}"
 
-    upsert_job(row, parsed)
+    return build_record(row, parsed)
 
 # ---------------- Main loop ----------------
+async def _parse_into(row: Dict[str, Any], records: List[Dict[str, Any]], on_done: Optional[Any] = None) -> None:
+    # ошибки строки гасим здесь: иначе TaskGroup отменит весь батч
+    try:
+        rec = await parse_one(row)
+        if rec: records.append(rec)
+    except Exception as e:
+        pretty_print(f"[red]Ошибка при парсинге:[/] {e!r}")
+    finally:
+        if on_done: on_done()
+
 async def main_loop(once: bool = False):
     cloud_note = CLOUD_MODEL and f"cloud: [magenta]{CLOUD_MODEL}[/] @ [cyan]{CLOUD_HOST}[/]" or "cloud: off"
-    local_note = f"local: [magenta]{LOCAL_MODEL}[/] @ [cyan]{LOCAL_HOST}[/]"
+    local_note = f"local: [magenta]{LOCAL_MODEL}[/] @ [cyan]{', '.join(LOCAL_HOSTS)}[/]"
     val_note = f"validator: [magenta]{VALIDATOR_MODEL or 'off'}[/] @ [cyan]{VALIDATOR_HOST}[/]" if ENABLE_VALIDATOR and VALIDATOR_MODEL else "validator: off"
     pretty_print(f"[bold cyan]GeoJobs[/] • {cloud_note} • {local_note} • {val_note} • src: [green]{RAW_TABLE}[/] → [yellow]{PARSED_TABLE}[/]")
     pretty_print(f"[dim]ENV check:[/] OLLAMA_MODEL={os.getenv('OLLAMA_MODEL')}  LLM_MODEL={os.getenv('LLM_MODEL')}  MODEL={os.getenv('MODEL')}")
 
-    global FALLBACK_ACTIVATED
     if CLOUD_MODEL and not FALLBACK_ACTIVATED:
         ok = await cloud_preflight()
         if not ok:
             pretty_print("[yellow]Cloud недоступен/лимит — заранее переключаюсь на локальную модель[/]")
-            FALLBACK_ACTIVATED = True
+            _activate_fallback()
+    await prewarm_models()
 
-    while True:
-        try:
-            batch = fetch_batch(BATCH_SIZE)
-        except Exception as e:
-            pretty_print(f"[red]Ошибка fetch_batch:[/] {e!r}")
-            if once: break
-            await asyncio.sleep(POLL_SECONDS); continue
+    # следующий батч читаем, пока разбирается текущий: запрос к БД прячется за LLM
+    next_fetch: Optional[asyncio.Task] = None
+    try:
+        while True:
+            fetch, next_fetch = next_fetch, None
+            try:
+                batch = await (fetch or fetch_batch(BATCH_SIZE))
+            except Exception as e:
+                pretty_print(f"[red]Ошибка fetch_batch:[/] {e!r}")
+                if once: break
+                await asyncio.sleep(POLL_SECONDS); continue
+
+            if not batch:
+                if once:
+                    pretty_print("[yellow]Нет новых записей — выходим[/]")
+                    break
+                if (os.getenv("PRETTY", "1") != "0") and HAS_RICH and Console:
+                    with Console().status(f"Жду новые записи из [green]{RAW_TABLE}[/]…", spinner="dots"):  # type: ignore
+                        await asyncio.sleep(POLL_SECONDS)
+                else:
+                    await asyncio.sleep(POLL_SECONDS)
+                continue
+
+            if not once:
+                next_fetch = asyncio.create_task(fetch_batch(BATCH_SIZE, [r.get("raw_id") for r in batch]))
+
+            total = len(batch)
+            pretty_print(f"[blue]Получен батч:[/] {total} записей")
+            records: List[Dict[str, Any]] = []
 
-        if not batch:
-            if once:
-                pretty_print("[yellow]Нет новых записей — выходим[/]")
-                break
             if (os.getenv("PRETTY", "1") != "0") and HAS_RICH and Console:
-                with Console().status(f"Жду новые записи из [green]{RAW_TABLE}[/]…", spinner="dots"):  # type: ignore
-                    await asyncio.sleep(POLL_SECONDS)
+                with Progress(
+                    SpinnerColumn(style="cyan"),  # type: ignore
+                    TextColumn("[progress.description]{task.description}"),  # type: ignore
+                    BarColumn(),  # type: ignore
+                    TextColumn("{task.completed}/{task.total}"),  # type: ignore
+                    TimeElapsedColumn(),  # type: ignore
+                    TimeRemainingColumn(),  # type: ignore
+                    console=Console(),  # type: ignore
+                    transient=True,
+                ) as progress:
+                    task = progress.add_task("Парсинг LLM…", total=total)  # type: ignore
+                    async with asyncio.TaskGroup() as tg:
+                        for r in batch:
+                            tg.create_task(_parse_into(r, records, lambda: progress.advance(task)))  # type: ignore
             else:
-                time.sleep(POLL_SECONDS)
-            continue
+                async with asyncio.TaskGroup() as tg:
+                    for r in batch:
+                        tg.create_task(_parse_into(r, records))
 
-        total = len(batch)
-        pretty_print(f"[blue]Получен батч:[/] {total} записей")
-
-        if (os.getenv("PRETTY", "1") != "0") and HAS_RICH and Console:
-            with Progress(
-                SpinnerColumn(style="cyan"),  # type: ignore
-                TextColumn("[progress.description]{task.description}"),  # type: ignore
-                BarColumn(),  # type: ignore
-                TextColumn("{task.completed}/{task.total}"),  # type: ignore
-                TimeElapsedColumn(),  # type: ignore
-                TimeRemainingColumn(),  # type: ignore
-                console=Console(),  # type: ignore
-                transient=True,
-            ) as progress:
-                task = progress.add_task("Парсинг LLM…", total=total)  # type: ignore
-                coros = [parse_one(r) for r in batch]
-                for fut in asyncio.as_completed(coros):
-                    try:
-                        await fut
-                    except Exception as e:
-                        pretty_print(f"[red]Ошибка при парсинге:[/] {e!r}")
-                    finally:
-                        progress.advance(task)  # type: ignore
-        else:
-            coros = [parse_one(r) for r in batch]
-            for fut in asyncio.as_completed(coros):
-                try:
-                    await fut
-                except Exception as e:
-                    print(f"Ошибка при парсинге: {e!r}")
+            # запись — одним заходом на батч, после разбора всех строк
+            try:
+                await upsert_jobs(records)
+            except Exception as e:
+                pretty_print(f"[red]Ошибка записи батча:[/] {e!r}")
 
-        pretty_print("[green]Батч обработан[/]")
-        if once: break
+            pretty_print("[green]Батч обработан[/]")
+            if once: break
+    finally:
+        # выход по исключению или Ctrl+C: не оставляем висящий запрос поверх закрывающегося пула
+        if next_fetch is not None:
+            next_fetch.cancel()
+            await asyncio.gather(next_fetch, return_exceptions=True)
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
@@ -803,10 +1391,18 @@ if __name__ == "__main__":
     # применяем CLI-оверрайды
     if args.local_model: LOCAL_MODEL = args.local_model
     if args.cloud_model: CLOUD_MODEL = args.cloud_model
-    if args.local_host:  LOCAL_HOST  = args.local_host.rstrip("/")
+    if args.local_host:  LOCAL_HOST  = args.local_host.rstrip("/"); LOCAL_HOSTS = [LOCAL_HOST]
     if args.cloud_host:  CLOUD_HOST  = args.cloud_host.rstrip("/")
 
+    async def _run():
+        try:
+            await main_loop(once=args.once)
+        finally:
+            await close_http()
+            await close_rest()
+            await close_pg()
+
     try:
-        asyncio.run(main_loop(once=args.once))
+        asyncio.run(_run())
     except KeyboardInterrupt:
         pretty_print("\n⏹ Остановлено пользователем")